@@ -7,6 +7,7 @@ import logging
 import time
 import math
 import numpy
+from vtk.util import numpy_support
 
 
 #
@@ -192,6 +193,8 @@ class LumpNavGuidelet(Guidelet):
     # Set needle and cautery transforms and models
     self.tumorMarkups_Needle = None
     self.tumorMarkups_NeedleObserver = None
+    # Tumor point positions, refreshed whenever the tumor surface is rebuilt
+    self.tumorMarkupsPositions = numpy.empty((0, 3))
 
     # Second fiducial node used to erase points
     self.eraseMarkups_Needle = slicer.vtkMRMLMarkupsFiducialNode()
@@ -1067,6 +1070,7 @@ class LumpNavGuidelet(Guidelet):
     # Surface generation algorithms behave unpredictably when there are not enough points
     # return if there are very few points
     if numberOfPoints<1:
+      self.tumorMarkupsPositions = numpy.empty((0, 3))
       return
     
     points.SetNumberOfPoints(numberOfPoints)
@@ -1074,6 +1078,7 @@ class LumpNavGuidelet(Guidelet):
     for i in range(numberOfPoints):
       self.tumorMarkups_Needle.GetNthFiducialPosition(i,new_coord)
       points.SetPoint(i, new_coord)
+    self.tumorMarkupsPositions = numpy_support.vtk_to_numpy(points.GetData()).astype(numpy.float64)
 
     if self.placeButton.isChecked() :
       if self.loggingFlag == False : 
@@ -1161,20 +1166,18 @@ class LumpNavGuidelet(Guidelet):
 
   # returns closest marked point to where eraser fiducial was placed
   def returnClosestPoint(self, fiducialNode, erasePoint) :
-    closestIndex = 0
     numberOfPoints = fiducialNode.GetNumberOfFiducials()
-    closestPosition = [0.0,0.0,0.0]
-    fiducialNode.GetNthFiducialPosition(0, closestPosition)
-    distanceToClosest = self.returnDistance(closestPosition, erasePoint)
-    fiducialPosition = [0.0,0.0,0.0]
-    for fiducialIndex in range(1, numberOfPoints) :
-      fiducialNode.GetNthFiducialPosition(fiducialIndex, fiducialPosition)
-      distanceToPoint = self.returnDistance(fiducialPosition, erasePoint)
-      if distanceToPoint < distanceToClosest :
-        closestIndex = fiducialIndex
-        distanceToClosest = distanceToPoint
-    fiducialNode.GetNthFiducialPosition(closestIndex, fiducialPosition)
-    logging.info("Used eraser to remove point at %s", fiducialPosition)
+    if fiducialNode == self.tumorMarkups_Needle and len(self.tumorMarkupsPositions) == numberOfPoints :
+      positions = self.tumorMarkupsPositions
+    else :
+      # positions are out of date, e.g. points were removed without a point modified event
+      positions = numpy.zeros((numberOfPoints, 3))
+      fiducialPosition = [0.0,0.0,0.0]
+      for fiducialIndex in range(numberOfPoints) :
+        fiducialNode.GetNthFiducialPosition(fiducialIndex, fiducialPosition)
+        positions[fiducialIndex] = fiducialPosition
+    closestIndex = int(numpy.argmin(numpy.linalg.norm(positions - numpy.array(erasePoint), axis=1)))
+    logging.info("Used eraser to remove point at %s", positions[closestIndex])
     return closestIndex
   
   def returnDistance(self, point1, point2) :
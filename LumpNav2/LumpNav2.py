@@ -4,10 +4,18 @@ import shutil
 import datetime
 import time
 import json
+import hashlib
+import collections
+import contextlib
+import queue
+import struct
+import threading
+import zlib
 from packaging import version
 
 import numpy as np
 import vtk, qt, ctk, slicer
+from vtk.util import numpy_support
 
 import logging
 from slicer.ScriptedLoadableModule import *
@@ -39,6 +47,14 @@ except:
   slicer.util.pip_install('pandas')
   import pandas as pd
 
+try:
+  from scipy import ndimage
+  from scipy.spatial import ConvexHull, QhullError, cKDTree
+except:
+  slicer.util.pip_install('scipy')
+  from scipy import ndimage
+  from scipy.spatial import ConvexHull, QhullError, cKDTree
+
 #
 # LumpNav2
 #
@@ -354,6 +370,9 @@ class LumpNav2Widget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     breachMarkupsProximityThreshold = slicer.util.settingsValue(self.logic.BREACH_MARKUPS_PROXIMITY_THRESHOLD, 1, converter=lambda x: int(x))
     self.ui.breachMarkupsThresholdSpinBox.value = breachMarkupsProximityThreshold
     self.ui.breachMarkupsThresholdSpinBox.connect('valueChanged(int)', self.onBreachMarkupsProximityChanged)
+    eraserRadius = slicer.util.settingsValue(self.logic.ERASER_RADIUS_SETTING, 0, converter=lambda x: int(x))
+    self.ui.eraserRadiusSpinBox.value = eraserRadius
+    self.ui.eraserRadiusSpinBox.connect('valueChanged(int)', self.onEraserRadiusChanged)
     self.ui.exitButton.connect('clicked()', self.onExitButtonClicked)
     self.ui.saveSceneButton.connect('clicked()', self.onSaveSceneClicked)
     lastSavePath = slicer.util.settingsValue(self.logic.SAVE_FOLDER_SETTING, os.path.dirname(slicer.util.modulePath(self.logic.moduleName)))
@@ -523,6 +542,11 @@ class LumpNav2Widget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     # Save position csv
     self.onExportCsvButtonClicked(sceneSaveDirectory)
 
+    # Keep the tracking journal with the scene
+    trackingJournalPath = self.logic.flushTrackingJournal()
+    if trackingJournalPath:
+      shutil.copy(trackingJournalPath, sceneSaveDirectory)
+
     # Move temp iKnife scan files to save directory
     scanSaveFolder = os.path.join(sceneSaveDirectory, "iKnifeScans")
     if not os.path.exists(scanSaveFolder):
@@ -769,6 +793,12 @@ class LumpNav2Widget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     logging.info(f"onBreachMarkupsProximityChanged({value})")
     settings = qt.QSettings()
     settings.setValue(self.logic.BREACH_MARKUPS_PROXIMITY_THRESHOLD, value)
+    self.logic.setBreachMarkupsProximityThreshold(value)
+
+  def onEraserRadiusChanged(self, value):
+    logging.info(f"onEraserRadiusChanged({value})")
+    settings = qt.QSettings()
+    settings.setValue(self.logic.ERASER_RADIUS_SETTING, value)
 
   def onFreezeUltrasoundClicked(self, toggled):
     logging.info(f"onFreezeUltrasoundClicked({toggled})")
@@ -1236,6 +1266,10 @@ class LumpNav2Widget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     if plusServerNode:
       plusServerNode.StopServer()
 
+    self.logic.closeTrackingJournal()
+    self.logic.tumorSurfaceWorker.stop()
+    self.logic.renderScheduler.reset()
+
     slicer.util.mainWindow().removeEventFilter(self.eventFilter)
 
     self.removeObservers()
@@ -1305,6 +1339,9 @@ class LumpNav2Widget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     # Parameter node will be reset, do not use it anymore
     self.setParameterNode(None)
 
+    # Views must not be rendered with annotations of the closed scene
+    self.logic.renderScheduler.reset()
+
   def onSceneEndClose(self, caller, event):
     """
     Called just after the scene is closed.
@@ -1555,6 +1592,1617 @@ class LumpNav2Widget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self._parameterNode.EndModify(wasModified)
 
 
+#
+# TrackingDataBuffer
+#
+
+class TrackingDataBuffer:
+  """
+  Typed columnar store for the per-frame tracking log. Every column is a preallocated NumPy array that grows
+  by doubling its capacity when full, so appending a row takes constant amortized time.
+  Missing float values are stored as NaN and missing integer values as MISSING_INT.
+  Margin columns hold up to MARGIN_SHELLS values; unused entries are NaN.
+  """
+
+  INITIAL_CAPACITY = 4096
+  MISSING_INT = -1
+  MARGIN_SHELLS = 5
+
+  # Column name: (dtype, number of components)
+  COLUMNS = {
+    "localTime": (np.float64, 1),
+    "time": (np.float64, 1),
+    "sendTime": (np.float64, 1),
+    "scanNumber": (np.int64, 1),
+    "tipNeedle": (np.float64, 3),
+    "distance": (np.float64, 1),
+    "speed": (np.float64, 1),
+    "tumorCenter": (np.float64, 3),
+    "tumorExtent": (np.float64, 3),
+    "tic": (np.int64, 1),
+    "marginSizes": (np.float64, MARGIN_SHELLS),
+    "marginDistances": (np.float64, MARGIN_SHELLS),
+  }
+
+  CSV_HEADER = ["Local Time", "Time (s)", "Scan Send Time", "Scan Number", "Cautery Tip Needle",
+                "Distance To Tumour (mm)", "Cautery Speed (mm/s)", "Tumor Center", "Tumor Dimensions", "TIC",
+                "Margin Sizes (mm)", "Distance To Margins (mm)"]
+
+  def __init__(self, capacity=INITIAL_CAPACITY):
+    self._capacity = max(int(capacity), 1)
+    self._size = 0
+    self._columns = {name: self._allocate(name, self._capacity) for name in self.COLUMNS}
+
+  def __len__(self):
+    return self._size
+
+  @classmethod
+  def fromRecords(cls, records):
+    """
+    Creates a buffer from a NumPy structured array. Fields that are not tracking log columns are ignored.
+    """
+    buffer = cls(capacity=len(records))
+    for name in cls.COLUMNS:
+      if records.dtype.names and name in records.dtype.names:
+        buffer._columns[name][:len(records)] = records[name]
+    buffer._size = len(records)
+    return buffer
+
+  @classmethod
+  def fromColumns(cls, **columns):
+    """
+    Creates a buffer from whole columns. All columns must have the same length; missing columns are left empty.
+    """
+    numberOfRows = len(next(iter(columns.values())))
+    buffer = cls(capacity=numberOfRows)
+    for name, values in columns.items():
+      buffer._columns[name][:numberOfRows] = values
+    buffer._size = numberOfRows
+    return buffer
+
+  @classmethod
+  def missingValue(cls, dtype):
+    return cls.MISSING_INT if np.issubdtype(dtype, np.integer) else np.nan
+
+  def _allocate(self, name, capacity):
+    dtype, components = self.COLUMNS[name]
+    shape = (capacity,) if components == 1 else (capacity, components)
+    return np.full(shape, self.missingValue(dtype), dtype=dtype)
+
+  def _grow(self):
+    newCapacity = self._capacity * 2
+    for name, column in self._columns.items():
+      newColumn = self._allocate(name, newCapacity)
+      newColumn[:self._size] = column[:self._size]
+      self._columns[name] = newColumn
+    self._capacity = newCapacity
+
+  def append(self, **values):
+    """
+    Adds one row. Columns that are not specified, or specified as None, are left as missing values.
+    :param values: column name to value (scalar, or sequence of 3 for vector columns)
+    :returns: int, index of the new row
+    """
+    if self._size == self._capacity:
+      self._grow()
+    row = self._size
+    for name, value in values.items():
+      if value is not None:
+        self._columns[name][row] = value
+    self._size += 1
+    return row
+
+  def clear(self):
+    self._size = 0
+    self._columns = {name: self._allocate(name, self._capacity) for name in self.COLUMNS}
+
+  def column(self, name):
+    """
+    Returns a read-only view of the filled part of a column.
+    """
+    view = self._columns[name][:self._size]
+    view.flags.writeable = False
+    return view
+
+  def toDataFrame(self):
+    """
+    Creates a DataFrame with the same column names and text formatting as the original tracking CSV export.
+    """
+    def formatFloats(values):
+      return ["" if np.isnan(v) else v for v in values.tolist()]
+
+    def formatInts(values):
+      return ["" if v == self.MISSING_INT else v for v in values.tolist()]
+
+    def formatVectors(values):
+      return ["" if np.isnan(v).any() else np.array2string(v) for v in values]
+
+    def formatPartialVectors(values):
+      return ["" if np.isnan(v).all() else np.array2string(v[~np.isnan(v)]) for v in values]
+
+    localTimes = ["" if np.isnan(t) else time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))
+                  for t in self.column("localTime").tolist()]
+    data = [
+      localTimes,
+      formatFloats(self.column("time")),
+      formatFloats(self.column("sendTime")),
+      formatInts(self.column("scanNumber")),
+      formatVectors(self.column("tipNeedle")),
+      formatFloats(self.column("distance")),
+      formatFloats(self.column("speed")),
+      formatVectors(self.column("tumorCenter")),
+      formatVectors(self.column("tumorExtent")),
+      formatInts(self.column("tic")),
+      formatPartialVectors(self.column("marginSizes")),
+      formatPartialVectors(self.column("marginDistances")),
+    ]
+    return pd.DataFrame(dict(zip(self.CSV_HEADER, data)), columns=self.CSV_HEADER)
+
+  def toNumericDataFrame(self):
+    """
+    Creates a DataFrame with one typed column per value, e.g. for Parquet. Position vectors are split into X, Y, Z
+    columns and margin columns into one column per margin shell.
+    """
+    data = {}
+    for header, name in zip(self.CSV_HEADER, self.COLUMNS):
+      values = self.column(name)
+      if values.ndim == 1:
+        data[header] = values
+      else:
+        componentNames = ["X", "Y", "Z"] if values.shape[1] == 3 else range(1, values.shape[1] + 1)
+        for component, componentName in enumerate(componentNames):
+          data[f"{header} {componentName}"] = values[:, component]
+    return pd.DataFrame(data)
+
+
+#
+# TrackingDataJournal
+#
+
+class TrackingDataJournal:
+  """
+  Append-only binary journal of tracking log rows, so that tracking data recorded during a case survives a crash.
+
+  The main thread only queues rows. A timer hands the queued rows to a background thread that packs them into
+  fixed-size records and writes them as chunks, so the Qt event loop never waits for the disk.
+  File layout:
+    header: MAGIC, VERSION, length of row description, row description (JSON list of [name, dtype, components])
+    chunk:  CHUNK_MAGIC, number of rows, CRC32 of payload, payload (packed records)
+    footer: chunk offset index (uint64), FOOTER_MAGIC, index offset, number of chunks, number of rows
+  The footer is only written by close(). Files without footer are read by scanning chunks until the first
+  incomplete or corrupted one.
+  If a write fails, the file is truncated to the end of the last complete chunk and the writer stops. The error is
+  kept in writeError and raised on the main thread by the next append() or flush(wait=True).
+  """
+
+  MAGIC = b"LNTJ"
+  VERSION = 1
+  CHUNK_MAGIC = b"LNTC"
+  FOOTER_MAGIC = b"LNTF"
+  CHUNK_ROWS = 1024
+  FLUSH_INTERVAL_MS = 1000
+  FILE_EXTENSION = ".lntj"
+
+  _HEADER = struct.Struct("<4sII")
+  _CHUNK_HEADER = struct.Struct("<4sII")
+  _FOOTER = struct.Struct("<4sQIQ")
+
+  def __init__(self, filePath, flushIntervalMs=FLUSH_INTERVAL_MS):
+    self.filePath = filePath
+    self.rowDescription = [[name, np.dtype(dtype).newbyteorder("<").str, components]
+                           for name, (dtype, components) in TrackingDataBuffer.COLUMNS.items()]
+    self._dtype = self.rowDtype(self.rowDescription)
+    self._pendingRows = []
+    self._writeQueue = queue.Queue()
+    self._chunkOffsets = []
+    self._numberOfRows = 0
+    self.writeError = None
+
+    self._file = open(filePath, "wb")
+    description = json.dumps(self.rowDescription).encode("utf-8")
+    self._file.write(self._HEADER.pack(self.MAGIC, self.VERSION, len(description)))
+    self._file.write(description)
+    self._file.flush()
+
+    self._writerThread = threading.Thread(target=self._writeLoop, name="TrackingDataJournal", daemon=True)
+    self._writerThread.start()
+
+    self._flushTimer = qt.QTimer()
+    self._flushTimer.setInterval(flushIntervalMs)
+    self._flushTimer.setSingleShot(False)
+    self._flushTimer.connect('timeout()', self.flush)
+    self._flushTimer.start()
+
+  @staticmethod
+  def rowDtype(rowDescription):
+    fields = []
+    for name, dtype, components in rowDescription:
+      fields.append((name, dtype) if components == 1 else (name, dtype, (components,)))
+    return np.dtype(fields)
+
+  def append(self, row):
+    """
+    Queues one row for writing. Does not touch the disk.
+    :param row: dict, column name to value, same keys as TrackingDataBuffer.append
+    :raises OSError: if the writer thread failed to write earlier rows
+    """
+    if self.writeError is not None:
+      raise OSError(f"Failed to write tracking journal {self.filePath}: {self.writeError}")
+    self._pendingRows.append(row)
+
+  def flush(self, wait=False):
+    """
+    Hands queued rows to the writer thread.
+    :param wait: bool, True to block until all rows are written to disk
+    :raises OSError: if wait is True and the writer thread failed to write
+    """
+    rows, self._pendingRows = self._pendingRows, []
+    if rows and self.writeError is None:
+      self._writeQueue.put(rows)
+    if wait:
+      self._writeQueue.join()
+      if self.writeError is not None:
+        raise OSError(f"Failed to write tracking journal {self.filePath}: {self.writeError}")
+
+  def close(self):
+    """
+    Writes all remaining rows, the chunk index and the footer, then closes the file. The footer is not written
+    after a write error; the file can still be read by scanning its complete chunks.
+    """
+    self._flushTimer.stop()
+    self.flush()
+    self._writeQueue.put(None)
+    self._writerThread.join()
+    try:
+      if self.writeError is None:
+        indexOffset = self._file.tell()
+        self._file.write(np.array(self._chunkOffsets, dtype="<u8").tobytes())
+        self._file.write(self._FOOTER.pack(self.FOOTER_MAGIC, indexOffset, len(self._chunkOffsets), self._numberOfRows))
+    finally:
+      self._file.close()
+    logging.info(f"Closed tracking journal {self.filePath} with {self._numberOfRows} rows")
+
+  def _writeLoop(self):
+    while True:
+      rows = self._writeQueue.get()
+      try:
+        if rows is None:
+          return
+        if self.writeError is None:
+          self._writeRows(rows)
+      finally:
+        self._writeQueue.task_done()
+
+  def _writeRows(self, rows):
+    """
+    Writes rows as chunks and syncs the file. On failure, removes the chunks of these rows from the file so it ends
+    with a complete chunk, and keeps the error in writeError.
+    """
+    startOffset = None
+    chunkOffsets = []
+    numberOfRows = 0
+    try:
+      startOffset = self._file.tell()
+      for start in range(0, len(rows), self.CHUNK_ROWS):
+        records = self._packRows(rows[start:start + self.CHUNK_ROWS])
+        chunkOffsets.append(self._writeChunk(records))
+        numberOfRows += len(records)
+      self._file.flush()
+      os.fsync(self._file.fileno())
+    except Exception as e:
+      self.writeError = e
+      logging.error(f"Failed to write tracking journal {self.filePath}, stopped writing: {e}")
+      if startOffset is not None:
+        try:
+          self._file.seek(startOffset)
+          self._file.truncate()
+        except Exception:
+          pass
+      return
+    self._chunkOffsets.extend(chunkOffsets)
+    self._numberOfRows += numberOfRows
+
+  def _packRows(self, rows):
+    records = np.empty(len(rows), dtype=self._dtype)
+    for name in self._dtype.names:
+      records[name] = TrackingDataBuffer.missingValue(self._dtype[name].base)
+    for i, row in enumerate(rows):
+      for name, value in row.items():
+        if value is not None:
+          records[name][i] = value
+    return records
+
+  def _writeChunk(self, records):
+    """
+    :returns: int, file offset of the chunk
+    """
+    payload = records.tobytes()
+    offset = self._file.tell()
+    self._file.write(self._CHUNK_HEADER.pack(self.CHUNK_MAGIC, len(records), zlib.crc32(payload)))
+    self._file.write(payload)
+    return offset
+
+  @classmethod
+  def read(cls, filePath):
+    """
+    Reads a journal, including one that was not closed properly.
+    :param filePath: str, path of the journal file
+    :returns: TrackingDataBuffer with all complete chunks
+    """
+    with open(filePath, "rb") as f:
+      data = f.read()
+
+    magic, version, descriptionLength = cls._HEADER.unpack_from(data, 0)
+    if magic != cls.MAGIC or version > cls.VERSION:
+      raise ValueError(f"{filePath} is not a supported tracking journal")
+    descriptionStart = cls._HEADER.size
+    rowDescription = json.loads(data[descriptionStart:descriptionStart + descriptionLength].decode("utf-8"))
+    dtype = cls.rowDtype(rowDescription)
+    firstChunkOffset = descriptionStart + descriptionLength
+
+    chunkOffsets = None
+    footerOffset = len(data) - cls._FOOTER.size
+    if footerOffset >= firstChunkOffset:
+      footerMagic, indexOffset, numberOfChunks, _ = cls._FOOTER.unpack_from(data, footerOffset)
+      if footerMagic == cls.FOOTER_MAGIC:
+        chunkOffsets = np.frombuffer(data, dtype="<u8", count=numberOfChunks, offset=indexOffset).tolist()
+        dataEnd = indexOffset
+    if chunkOffsets is None:
+      logging.warning(f"Tracking journal {filePath} has no footer, scanning chunks")
+      dataEnd = len(data)
+
+    chunks = []
+    offset = firstChunkOffset
+    chunkIndex = 0
+    while True:
+      if chunkOffsets is not None:
+        if chunkIndex >= len(chunkOffsets):
+          break
+        offset = chunkOffsets[chunkIndex]
+      if offset + cls._CHUNK_HEADER.size > dataEnd:
+        break
+      chunkMagic, numberOfRows, checksum = cls._CHUNK_HEADER.unpack_from(data, offset)
+      payloadStart = offset + cls._CHUNK_HEADER.size
+      payloadEnd = payloadStart + numberOfRows * dtype.itemsize
+      if chunkMagic != cls.CHUNK_MAGIC or payloadEnd > dataEnd:
+        logging.warning(f"Tracking journal {filePath} is truncated at byte {offset}")
+        break
+      payload = data[payloadStart:payloadEnd]
+      if zlib.crc32(payload) != checksum:
+        logging.warning(f"Tracking journal {filePath} has a corrupted chunk at byte {offset}")
+        break
+      chunks.append(np.frombuffer(payload, dtype=dtype))
+      offset = payloadEnd
+      chunkIndex += 1
+
+    records = np.concatenate(chunks) if chunks else np.empty(0, dtype=dtype)
+    return TrackingDataBuffer.fromRecords(records)
+
+
+#
+# GeometryStatisticsCache
+#
+
+class GeometryStatisticsCache:
+  """
+  Caches the point centroid and bounding box size of model nodes. Statistics are computed once per polydata
+  modification from a zero-copy NumPy view of the points, and looked up by node ID and polydata MTime after that.
+  The centroid is reported with X and Y negated (LPS to RAS), as in the tracking log.
+  """
+
+  LPS_TO_RAS = np.array([-1.0, -1.0, 1.0])
+
+  def __init__(self):
+    self._entries = {}  # node ID -> (polydata, polydata MTime, center, extent)
+
+  def getCenterAndExtent(self, modelNode):
+    """
+    :param modelNode: vtkMRMLModelNode
+    :returns: (center, extent) as NumPy arrays of 3, or (None, None) if the model has no points
+    """
+    if modelNode is None:
+      return None, None
+    polydata = modelNode.GetPolyData()
+    if polydata is None or polydata.GetNumberOfPoints() == 0:
+      self._entries.pop(modelNode.GetID(), None)
+      return None, None
+
+    mtime = polydata.GetMTime()
+    entry = self._entries.get(modelNode.GetID())
+    if entry is not None and entry[0] is polydata and entry[1] == mtime:
+      return entry[2], entry[3]
+
+    points = numpy_support.vtk_to_numpy(polydata.GetPoints().GetData())
+    center = points.mean(axis=0, dtype=np.float64) * self.LPS_TO_RAS
+    extent = points.max(axis=0).astype(np.float64) - points.min(axis=0)
+    self._entries[modelNode.GetID()] = (polydata, mtime, center, extent)
+    return center, extent
+
+  def clear(self):
+    self._entries.clear()
+
+
+#
+# SignedDistanceEngine
+#
+
+class SignedDistanceEngine:
+  """
+  Batched signed distance from an (N,3) array of points to a closed surface, negative inside the surface as reported
+  by the breach warning node. Both must be in the same coordinate system (e.g. tumor model and cautery tip in Needle).
+  EXACT mode evaluates vtkImplicitPolyDataDistance (the same distance as the breach warning node) for all points in
+  one VTK call. GRID mode samples the signed distance once on a regular grid around the surface and interpolates it
+  trilinearly in NumPy, which is much faster for long recordings or repeated queries. The grid is only used within
+  padding of the surface, where its error against exact distances is checked. It is refined until that error is
+  within tolerance, and EXACT mode is used if that needs more than maxGridPoints or maxBuildSeconds. Creased
+  surfaces, such as the Delaunay tumor surface, often need EXACT mode for the default tolerance.
+  Points outside the grid or the padding band are always evaluated exactly.
+  """
+
+  EXACT = "exact"
+  GRID = "grid"
+  TOLERANCE_DEFAULT = 0.1  # mm
+  PADDING_DEFAULT = 10.0  # mm
+  MAX_GRID_POINTS_DEFAULT = 4000000
+  MAX_BUILD_SECONDS_DEFAULT = 2.0
+  INITIAL_SPACING_FACTOR = 8.0  # initial grid spacing relative to tolerance
+  VALIDATION_POINTS = 2000
+  SAMPLING_CHUNK_POINTS = 100000
+
+  def __init__(self, polydata, mode=EXACT, tolerance=TOLERANCE_DEFAULT, padding=PADDING_DEFAULT,
+               maxGridPoints=MAX_GRID_POINTS_DEFAULT, maxBuildSeconds=MAX_BUILD_SECONDS_DEFAULT):
+    """
+    :param polydata: vtkPolyData, closed surface
+    :param mode: EXACT or GRID
+    :param tolerance: maximum allowed difference from exact distances in GRID mode (mm)
+    :param padding: distance of the grid boundaries from the surface bounds, and of the interpolated band from the
+      surface (mm)
+    :param maxGridPoints: GRID mode falls back to EXACT if the tolerance needs more grid points than this
+    :param maxBuildSeconds: GRID mode falls back to EXACT if the grid would take longer than this to build
+    """
+    self.tolerance = tolerance
+    self.padding = padding
+    self.maxGridPoints = maxGridPoints
+    self.maxBuildSeconds = maxBuildSeconds
+    self.mode = mode
+    self.maxGridError = None
+    self.grid = None
+    self.gridOrigin = None
+    self.gridSpacing = None
+    self._implicitDistance = vtk.vtkImplicitPolyDataDistance()
+    self._implicitDistance.SetInput(polydata)
+    self._bounds = np.array(polydata.GetBounds()).reshape(3, 2)
+    if mode == self.GRID:
+      self._buildGrid()
+
+  def _buildGrid(self):
+    # Interpolation error is largest near the surface and shrinks with the square of the spacing on smooth surfaces.
+    # Start coarse and halve the spacing until the measured error is within tolerance. Samples of the coarser grid
+    # are reused as every second sample of the finer grid.
+    buildTimer = [time.perf_counter(), 0]  # start time, number of sampled points
+    lower = self._bounds[:, 0] - self.padding
+    size = self._bounds[:, 1] + self.padding - lower
+    spacing = self.INITIAL_SPACING_FACTOR * self.tolerance
+    dimensions = np.ceil(size / spacing).astype(int) + 1
+    grid = None
+    while np.prod(dimensions) <= self.maxGridPoints:
+      values = np.empty(dimensions)
+      missing = np.ones(dimensions, dtype=bool)
+      if grid is not None:
+        values[::2, ::2, ::2] = grid
+        missing[::2, ::2, ::2] = False
+      missingIndex = np.nonzero(missing)
+      missingValues = self._sampleWithinBudget(lower + spacing * np.column_stack(missingIndex), buildTimer)
+      if missingValues is None:
+        break
+      values[missingIndex] = missingValues
+      grid = values
+
+      self.grid = grid
+      self.gridOrigin = lower
+      self.gridSpacing = spacing
+      self.maxGridError = self._measureGridError()
+      if self.maxGridError <= self.tolerance:
+        return
+      spacing /= 2.0
+      dimensions = 2 * dimensions - 1
+
+    logging.info(f"Signed distance grid cannot meet tolerance {self.tolerance} mm within {self.maxGridPoints} points "
+                 f"and {self.maxBuildSeconds} s, using exact distances")
+    self.mode = self.EXACT
+    self.grid = None
+
+  def _sampleWithinBudget(self, points, buildTimer):
+    # Exact distances of the points in chunks. The build time is extrapolated from the sampling rate so far, and
+    # None is returned as soon as sampling all points would exceed maxBuildSeconds.
+    startTime, sampledPoints = buildTimer
+    values = np.empty(len(points))
+    for start in range(0, len(points), self.SAMPLING_CHUNK_POINTS):
+      elapsed = time.perf_counter() - startTime
+      if sampledPoints > 0 and elapsed * (sampledPoints + len(points) - start) / sampledPoints > self.maxBuildSeconds:
+        return None
+      stop = start + self.SAMPLING_CHUNK_POINTS
+      values[start:stop] = self.exactDistances(points[start:stop])
+      sampledPoints += len(values[start:stop])
+      buildTimer[1] = sampledPoints
+    return values
+
+  def _measureGridError(self):
+    # Interpolation error peaks at cell centers where the distance field bends: near the surface, at creases of the
+    # surface, and along ridges such as the medial axis inside the tumor. Only the band within padding of the surface
+    # is interpolated, so deep ridges are skipped. Check the cells around the band grid points with the largest second
+    # differences, the cells closest to the surface, and random band cells.
+    grid = self.grid
+    upper = np.array(grid.shape) - 2
+    band = np.abs(grid) <= self.padding
+    secondDifference = np.zeros(grid.shape)
+    inner = (slice(1, -1),) * 3
+    for axis in range(3):
+      before = [slice(1, -1)] * 3
+      after = [slice(1, -1)] * 3
+      before[axis] = slice(0, -2)
+      after[axis] = slice(2, None)
+      secondDifference[inner] += np.abs(grid[tuple(before)] - 2.0 * grid[inner] + grid[tuple(after)])
+    secondDifference[~band] = 0.0
+    count = min(self.VALIDATION_POINTS, grid.size)
+    bendingNodes = np.argpartition(secondDifference.ravel(), -count)[-count:]
+    surfaceNodes = np.argpartition(np.abs(grid).ravel(), count - 1)[:count]
+    nodes = np.column_stack(np.unravel_index(np.concatenate((bendingNodes, surfaceNodes)), grid.shape))
+    rng = np.random.default_rng(0)
+    bandNodes = np.flatnonzero(band)
+    randomNodes = np.column_stack(np.unravel_index(rng.choice(bandNodes, size=min(count, len(bandNodes))), grid.shape))
+    cells = np.concatenate((
+      np.clip(nodes, 0, upper),
+      np.clip(nodes - 1, 0, upper),
+      np.clip(randomNodes, 0, upper)))
+    samples = self.gridOrigin + self.gridSpacing * (cells + 0.5)
+    exact = self.exactDistances(samples)
+    inBand = np.abs(exact) <= self.padding
+    if not np.any(inBand):
+      return 0.0
+    return float(np.max(np.abs(self._interpolate(samples[inBand])[0] - exact[inBand])))
+
+  def _interpolate(self, points):
+    """
+    :returns: (distances, inside) where inside marks the points within the grid; other distances are undefined
+    """
+    index = (points - self.gridOrigin) / self.gridSpacing
+    upper = np.array(self.grid.shape) - 1
+    inside = np.all((index >= 0) & (index <= upper), axis=1)
+    corner = np.clip(np.floor(index).astype(int), 0, upper - 1)
+    t = np.clip(index - corner, 0.0, 1.0)
+    i, j, k = corner[:, 0], corner[:, 1], corner[:, 2]
+    tx, ty, tz = t[:, 0], t[:, 1], t[:, 2]
+    g = self.grid
+    c00 = g[i, j, k] * (1 - tx) + g[i + 1, j, k] * tx
+    c10 = g[i, j + 1, k] * (1 - tx) + g[i + 1, j + 1, k] * tx
+    c01 = g[i, j, k + 1] * (1 - tx) + g[i + 1, j, k + 1] * tx
+    c11 = g[i, j + 1, k + 1] * (1 - tx) + g[i + 1, j + 1, k + 1] * tx
+    c0 = c00 * (1 - ty) + c10 * ty
+    c1 = c01 * (1 - ty) + c11 * ty
+    return c0 * (1 - tz) + c1 * tz, inside
+
+  def exactDistances(self, points):
+    """
+    :param points: (N,3) array
+    :returns: (N,) array of signed distances computed by vtkImplicitPolyDataDistance
+    """
+    points = np.ascontiguousarray(points, dtype=np.float64).reshape(-1, 3)
+    if len(points) == 0:
+      return np.empty(0)
+    output = vtk.vtkDoubleArray()
+    self._implicitDistance.FunctionValue(numpy_support.numpy_to_vtk(points), output)
+    return numpy_support.vtk_to_numpy(output).copy()
+
+  def distances(self, points):
+    """
+    :param points: (N,3) array
+    :returns: (N,) array of signed distances, negative inside the surface
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    if self.mode != self.GRID:
+      return self.exactDistances(points)
+    result, inside = self._interpolate(points)
+    exact = ~inside | (np.abs(result) > self.padding)
+    if np.any(exact):
+      result[exact] = self.exactDistances(points[exact])
+    return result
+
+
+#
+# MarginDistanceEvaluator
+#
+
+class MarginDistanceEvaluator:
+  """
+  Distances from points to a tumor model and to each of its margin shells (the tumor dilated by a margin size).
+  Shells are iso-offsets of the tumor signed distance field: the distance to a shell of margin m is the distance to
+  the tumor minus m. One distance evaluation per point gives all shells, so the cost does not grow with the number
+  of shells. The margin sizes are stored as an attribute of the tumor model node, so they are saved with the scene.
+  The distance engine is only rebuilt when the tumor polydata changes.
+  """
+
+  MARGIN_SIZES_ATTRIBUTE = "LumpNav2.MarginSizesMm"
+
+  def __init__(self, mode=SignedDistanceEngine.EXACT):
+    """
+    :param mode: SignedDistanceEngine mode. EXACT suits a few points per tumor change, GRID suits long recordings.
+    """
+    self.mode = mode
+    self._engine = None
+    self._engineKey = None
+
+  @classmethod
+  def getMarginSizes(cls, modelNode):
+    """
+    :returns: sorted NumPy array of the margin sizes (mm) of the model node
+    """
+    if modelNode is None:
+      return np.empty(0)
+    attribute = modelNode.GetAttribute(cls.MARGIN_SIZES_ATTRIBUTE)
+    if not attribute:
+      return np.empty(0)
+    return np.array(sorted(float(size) for size in attribute.split(",")))
+
+  @classmethod
+  def addMarginSize(cls, modelNode, marginSize):
+    marginSizes = set(cls.getMarginSizes(modelNode).tolist())
+    marginSizes.add(float(marginSize))
+    if len(marginSizes) > TrackingDataBuffer.MARGIN_SHELLS:
+      logging.warning(f"Only the {TrackingDataBuffer.MARGIN_SHELLS} smallest margins of {modelNode.GetName()} "
+                      f"are recorded in the tracking log")
+    modelNode.SetAttribute(cls.MARGIN_SIZES_ATTRIBUTE, ",".join(f"{size:g}" for size in sorted(marginSizes)))
+
+  def getEngine(self, modelNode):
+    """
+    :returns: SignedDistanceEngine for the current polydata of the model node, or None if the model is empty
+    """
+    polydata = modelNode.GetPolyData() if modelNode is not None else None
+    if polydata is None or polydata.GetNumberOfPoints() == 0:
+      return None
+    key = (modelNode.GetID(), polydata, polydata.GetMTime())
+    if key != self._engineKey:
+      self._engine = SignedDistanceEngine(polydata, mode=self.mode)
+      self._engineKey = key
+    return self._engine
+
+  def getDistances(self, modelNode, points, tumorDistances=None):
+    """
+    :param modelNode: vtkMRMLModelNode of the tumor
+    :param points: (N,3) array in the model coordinate system
+    :param tumorDistances: (N,) array of already known distances to the tumor, e.g. from the breach warning node
+    :returns: (marginSizes, marginDistances) as (N, MARGIN_SHELLS) arrays padded with NaN, as in the tracking log
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    marginSizes = np.full((len(points), TrackingDataBuffer.MARGIN_SHELLS), np.nan)
+    marginDistances = np.full((len(points), TrackingDataBuffer.MARGIN_SHELLS), np.nan)
+    sizes = self.getMarginSizes(modelNode)[:TrackingDataBuffer.MARGIN_SHELLS]
+    if len(sizes) == 0:
+      return marginSizes, marginDistances
+    if tumorDistances is None:
+      engine = self.getEngine(modelNode)
+      if engine is None:
+        return marginSizes, marginDistances
+      tumorDistances = engine.distances(points)
+    marginSizes[:, :len(sizes)] = sizes
+    marginDistances[:, :len(sizes)] = np.asarray(tumorDistances, dtype=np.float64).reshape(-1, 1) - sizes
+    return marginSizes, marginDistances
+
+
+#
+# TumorDistanceMap
+#
+
+class TumorDistanceMap:
+  """
+  Signed distance map of a closed surface, sampled on a voxel grid that covers the surface bounds plus the largest
+  distance of interest. The surface is rasterized with vtkPolyDataToImageStencil and the distances come from the
+  Euclidean distance transform of the inside and outside voxels, so no segmentation node or segment editor is needed.
+  Distances are negative inside. The rasterized boundary is quantized to voxel centers, so distances, and surfaces
+  dilated from them, are off by up to about one voxel spacing (0.25 mm on a sphere and up to 0.57 mm on a tumor
+  surface at the default 0.5 mm spacing). The surface dilated by a margin is the iso-surface of the map at the margin.
+  """
+
+  SPACING_DEFAULT = 0.5  # mm
+  MAX_VOXELS_DEFAULT = 8000000
+
+  def __init__(self, polyData, maximumDistance, spacing=SPACING_DEFAULT, maxVoxels=MAX_VOXELS_DEFAULT):
+    """
+    :param polyData: closed surface
+    :param maximumDistance: largest margin (mm) that will be extracted
+    :param spacing: voxel spacing (mm). Increased if the grid would need more than maxVoxels.
+    """
+    if polyData is None or polyData.GetNumberOfPoints() == 0:
+      raise ValueError("Cannot compute distance map of an empty surface")
+    bounds = np.array(polyData.GetBounds()).reshape(3, 2)
+    requestedSpacing = spacing
+    while True:
+      padding = max(maximumDistance, 0.0) + 2 * spacing
+      size = bounds[:, 1] - bounds[:, 0] + 2 * padding
+      voxels = np.prod(np.ceil(size / spacing) + 1)
+      if voxels <= maxVoxels:
+        break
+      spacing *= 1.01 * (voxels / maxVoxels) ** (1.0 / 3.0)
+    if spacing != requestedSpacing:
+      logging.warning(f"Distance map spacing increased to {spacing:.2f} mm to stay within {maxVoxels} voxels")
+    self.spacing = spacing
+    self.maximumDistance = maximumDistance
+    self.origin = bounds[:, 0] - padding
+    self.dimensions = np.ceil(size / spacing).astype(int) + 1
+
+    inside = self._rasterize(polyData)
+    if not np.any(inside):
+      raise ValueError("Surface does not enclose any voxel of the distance map")
+    # Distances between voxel centers are about half a voxel longer than distances to the surface between them.
+    # The shift centers the error, but voxel centers near the surface are still up to about a voxel off.
+    halfSpacing = spacing / 2.0
+    outsideDistances = ndimage.distance_transform_edt(~inside, sampling=spacing)
+    insideDistances = ndimage.distance_transform_edt(inside, sampling=spacing)
+    self.distances = np.where(inside, halfSpacing - insideDistances, outsideDistances - halfSpacing).astype(np.float32)
+    self._negatedDistances = np.ascontiguousarray(-self.distances.ravel())
+
+  def _rasterize(self, polyData):
+    """
+    :returns: boolean array of the voxels inside the surface, indexed [k, j, i]
+    """
+    stencil = vtk.vtkPolyDataToImageStencil()
+    stencil.SetInputData(polyData)
+    stencil.SetOutputOrigin(*self.origin)
+    stencil.SetOutputSpacing(self.spacing, self.spacing, self.spacing)
+    stencil.SetOutputWholeExtent(0, self.dimensions[0] - 1, 0, self.dimensions[1] - 1, 0, self.dimensions[2] - 1)
+    stencilToImage = vtk.vtkImageStencilToImage()
+    stencilToImage.SetInputConnection(stencil.GetOutputPort())
+    stencilToImage.SetInsideValue(1)
+    stencilToImage.SetOutsideValue(0)
+    stencilToImage.SetOutputScalarTypeToUnsignedChar()
+    stencilToImage.Update()
+    labels = numpy_support.vtk_to_numpy(stencilToImage.GetOutput().GetPointData().GetScalars())
+    return labels.reshape(self.dimensions[::-1]).astype(bool)
+
+  def getImageData(self):
+    """
+    :returns: new vtkImageData of the negated distances, so that contour normals point out of the surface.
+      All image data objects share the distance array, which must not be modified.
+    """
+    imageData = vtk.vtkImageData()
+    imageData.SetOrigin(*self.origin)
+    imageData.SetSpacing(self.spacing, self.spacing, self.spacing)
+    imageData.SetDimensions(*self.dimensions)
+    imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(self._negatedDistances, deep=False))
+    return imageData
+
+  def extractSurface(self, distance):
+    """
+    :param distance: margin (mm), at most maximumDistance. Negative values give surfaces inside the tumor.
+    :returns: vtkPolyData of the surface at the given signed distance, with outward normals
+    """
+    if distance > self.maximumDistance:
+      raise ValueError(f"Margin {distance} mm is larger than the distance map range {self.maximumDistance} mm")
+    contour = vtk.vtkFlyingEdges3D()
+    contour.SetInputData(self.getImageData())
+    contour.SetValue(0, -distance)
+    contour.ComputeNormalsOn()
+    contour.ComputeScalarsOff()
+    contour.Update()
+    return contour.GetOutput()
+
+  def extractSurfaces(self, distances):
+    """
+    Extracts several margins from the same distance map. vtkFlyingEdges3D already uses all CPU cores (vtkSMPTools),
+    so the surfaces are extracted one after another.
+    :param distances: list of margins (mm)
+    :returns: list of vtkPolyData, in the order of distances
+    """
+    return [self.extractSurface(distance) for distance in distances]
+
+
+#
+# ConvexHullOffset
+#
+
+class ConvexHullOffset:
+  """
+  Dilation of a convex surface by a margin without voxelization. The dilated surface (Minkowski sum with a sphere)
+  of a convex polyhedron is made of its facets moved out along their normals by the margin, cylinders around its
+  edges and sphere caps at its vertices. The moved facets are reproduced exactly. Cylinders and caps are sampled
+  so that the tessellation is within about TOLERANCE of them. Every sample is on the exact surface, and the result
+  is the convex hull of the samples. isConvex tells whether the surface is convex, i.e. all its points are within
+  CONVEXITY_TOLERANCE of the convex hull boundary. Other surfaces must be dilated with TumorDistanceMap.
+  """
+
+  TOLERANCE = 0.01  # mm
+  CONVEXITY_TOLERANCE = 0.01  # mm
+  SUPPORT_CHUNK_DIRECTIONS = 256
+
+  def __init__(self, polyData):
+    """
+    :param polyData: closed surface
+    """
+    cleanFilter = vtk.vtkCleanPolyData()  # also drops points that are not used by any cell
+    cleanFilter.SetInputData(polyData)
+    cleanFilter.Update()
+    cleanPoints = cleanFilter.GetOutput().GetPoints()
+    points = numpy_support.vtk_to_numpy(cleanPoints.GetData()).astype(np.float64) if cleanPoints else np.empty((0, 3))
+    self.hull = None
+    self.isConvex = False
+    if len(points) < 4:
+      return
+    try:
+      self.hull = ConvexHull(points)
+    except QhullError:
+      return  # flat or degenerate
+    self.isConvex = self._allPointsOnHull(points)
+
+  def _allPointsOnHull(self, points):
+    onHull = np.zeros(len(points), dtype=bool)
+    onHull[self.hull.vertices] = True
+    onHull[self.hull.coplanar[:, 0]] = True
+    innerPoints = points[~onHull]
+    equations = self.hull.equations
+    chunkSize = max(1, 4000000 // len(equations))
+    for start in range(0, len(innerPoints), chunkSize):
+      depths = -np.max(innerPoints[start:start + chunkSize] @ equations[:, :3].T + equations[:, 3], axis=1)
+      if np.any(depths > self.CONVEXITY_TOLERANCE):
+        return False
+    return True
+
+  @staticmethod
+  def sphereDirections(count):
+    """
+    :returns: (count,3) array of unit vectors evenly spread on the sphere (Fibonacci lattice)
+    """
+    indices = np.arange(count) + 0.5
+    z = 1.0 - 2.0 * indices / count
+    radius = np.sqrt(1.0 - z * z)
+    azimuth = np.pi * (1.0 + 5.0 ** 0.5) * indices
+    return np.column_stack((radius * np.cos(azimuth), radius * np.sin(azimuth), z))
+
+  def offsetSurface(self, distance):
+    """
+    :param distance: margin (mm), must be positive
+    :returns: vtkPolyData of the dilated surface with outward normals
+    """
+    if not self.isConvex:
+      raise ValueError("Surface is not convex")
+    if distance <= 0:
+      raise ValueError(f"Margin must be positive, got {distance} mm")
+    # Largest angle between samples on a circle of radius distance with chords within TOLERANCE of the arc
+    angleStep = 2.0 * np.arccos(max(1.0 - self.TOLERANCE / distance, 0.0))
+    points = self.hull.points
+    simplices = self.hull.simplices
+    normals = self.hull.equations[:, :3]
+
+    # Facets moved out along their normals. Where all facets around a vertex are within angleStep, e.g. on finely
+    # tessellated smooth surfaces, their mean normal replaces them.
+    cornerVertices = simplices.ravel()
+    cornerNormals = np.repeat(normals, 3, axis=0)
+    meanNormals = np.zeros_like(points)
+    np.add.at(meanNormals, cornerVertices, cornerNormals)
+    usedVertices = self.hull.vertices
+    meanNormals[usedVertices] /= np.linalg.norm(meanNormals[usedVertices], axis=1)[:, np.newaxis]
+    minimumCosines = np.ones(len(points))
+    np.minimum.at(minimumCosines, cornerVertices, np.einsum("ij,ij->i", cornerNormals, meanNormals[cornerVertices]))
+    narrow = minimumCosines >= np.cos(angleStep / 2.0)
+    narrowVertices = usedVertices[narrow[usedVertices]]
+    wideCorners = ~narrow[cornerVertices]
+    samples = [points[narrowVertices] + distance * meanNormals[narrowVertices],
+               points[cornerVertices[wideCorners]] + distance * cornerNormals[wideCorners]]
+
+    # Cylinders around edges, sampled by interpolating between the normals of the two facets of the edge
+    facets = np.repeat(np.arange(len(simplices)), 3)
+    neighbors = self.hull.neighbors.ravel()
+    oppositeVertex = np.tile(np.arange(3), len(simplices))
+    once = facets < neighbors
+    facets, neighbors, oppositeVertex = facets[once], neighbors[once], oppositeVertex[once]
+    angles = np.arccos(np.clip(np.einsum("ij,ij->i", normals[facets], normals[neighbors]), -1.0, 1.0))
+    steps = np.ceil(angles / angleStep).astype(int)
+    rounded = steps > 1
+    if np.any(rounded):
+      edgeFacets, edgeNeighbors, edgeAngles = facets[rounded], neighbors[rounded], angles[rounded]
+      edgeSteps = steps[rounded]
+      edgeVertices = np.column_stack((simplices[edgeFacets, (oppositeVertex[rounded] + 1) % 3],
+                                      simplices[edgeFacets, (oppositeVertex[rounded] + 2) % 3]))
+      sampleCounts = edgeSteps - 1
+      edgeIndex = np.repeat(np.arange(len(edgeSteps)), sampleCounts)
+      firstSample = np.repeat(np.cumsum(sampleCounts) - sampleCounts, sampleCounts)
+      t = ((np.arange(len(edgeIndex)) - firstSample + 1) / edgeSteps[edgeIndex])[:, np.newaxis]
+      angle = edgeAngles[edgeIndex][:, np.newaxis]
+      directions = (np.sin((1.0 - t) * angle) * normals[edgeFacets[edgeIndex]]
+                    + np.sin(t * angle) * normals[edgeNeighbors[edgeIndex]]) / np.sin(angle)
+      for endpoint in range(2):
+        samples.append(points[edgeVertices[edgeIndex, endpoint]] + distance * directions)
+
+    # Sphere caps at vertices: each direction is moved to the vertex furthest along it
+    vertices = points[self.hull.vertices]
+    directions = self.sphereDirections(int(np.ceil(8.0 * np.pi / angleStep ** 2)))
+    for start in range(0, len(directions), self.SUPPORT_CHUNK_DIRECTIONS):
+      chunk = directions[start:start + self.SUPPORT_CHUNK_DIRECTIONS]
+      supportVertices = vertices[np.argmax(chunk @ vertices.T, axis=1)]
+      samples.append(supportVertices + distance * chunk)
+
+    normalsFilter = vtk.vtkPolyDataNormals()
+    normalsFilter.SetInputData(IncrementalTumorHull.hullToPolyData(ConvexHull(np.vstack(samples))))
+    normalsFilter.SplittingOff()
+    normalsFilter.Update()
+    return normalsFilter.GetOutput()
+
+
+#
+# TransformCache
+#
+
+class TransformCache(VTKObservationMixin):
+  """
+  Resolves the cautery and needle transforms once per tracking update and shares the results as NumPy 4x4 arrays
+  between all callbacks handling the same update. The cached matrices are invalidated when any of the observed
+  transform nodes (or their parents) are modified. Returned arrays must not be modified by the caller.
+  """
+
+  def __init__(self):
+    VTKObservationMixin.__init__(self)
+    self.hits = 0
+    self.misses = 0
+    self._cauteryTipToCautery = None
+    self._needleToReference = None
+    self._matrices = None
+    self._cauteryTipToRasMatrix = vtk.vtkMatrix4x4()
+    self._needleToRasMatrix = vtk.vtkMatrix4x4()
+
+  def setTransformNodes(self, cauteryTipToCautery, needleToReference):
+    self.removeObservers(method=self.invalidate)
+    self._cauteryTipToCautery = cauteryTipToCautery
+    self._needleToReference = needleToReference
+    # Higher priority than other observers, so they never see matrices of the previous update
+    for transformNode in (cauteryTipToCautery, needleToReference):
+      self.addObserver(transformNode, slicer.vtkMRMLTransformNode.TransformModifiedEvent, self.invalidate, priority=100.0)
+    self.invalidate()
+
+  def invalidate(self, caller=None, event=None):
+    self._matrices = None
+
+  def getMatrices(self):
+    """
+    :returns: tuple of NumPy 4x4 arrays (CauteryTipToRas, CauteryTipToNeedle, NeedleToRas)
+    """
+    if self._matrices is not None:
+      self.hits += 1
+      return self._matrices
+    self.misses += 1
+    self._cauteryTipToCautery.GetMatrixTransformToWorld(self._cauteryTipToRasMatrix)
+    self._needleToReference.GetMatrixTransformToWorld(self._needleToRasMatrix)
+    cauteryTipToRas = slicer.util.arrayFromVTKMatrix(self._cauteryTipToRasMatrix)
+    needleToRas = slicer.util.arrayFromVTKMatrix(self._needleToRasMatrix)
+    cauteryTipToNeedle = np.linalg.inv(needleToRas) @ cauteryTipToRas
+    for matrix in (cauteryTipToRas, cauteryTipToNeedle, needleToRas):
+      matrix.flags.writeable = False
+    self._matrices = (cauteryTipToRas, cauteryTipToNeedle, needleToRas)
+    return self._matrices
+
+  def resetCounters(self):
+    self.hits = 0
+    self.misses = 0
+
+
+#
+# ViewRenderScheduler
+#
+
+class ViewRenderScheduler:
+  """
+  Coalesces renders of views whose corner annotation is updated at tracking rate. Annotation text and color are
+  compared against the last values set through the scheduler, and views are only marked dirty if something changed.
+  Dirty views are rendered with one scheduleRender call each, deferred to the next event loop iteration, so any
+  number of updates within the same iteration costs at most one render per view.
+  """
+
+  def __init__(self):
+    self.renderCount = 0
+    self.avoidedRenderCount = 0
+    self._annotationStates = {}  # vtkCornerAnnotation -> (texts, color)
+    self._dirtyViews = {}  # vtkCornerAnnotation -> view
+    self._flushPending = False
+
+  def setCornerAnnotation(self, view, texts, color):
+    """
+    :param view: ctkVTKAbstractView
+    :param texts: dict of vtkCornerAnnotation text position -> text
+    :param color: (r, g, b) color of all corner annotation text in the view
+    """
+    cornerAnnotation = view.cornerAnnotation()
+    previousTexts, previousColor = self._annotationStates.get(cornerAnnotation, ({}, None))
+    texts = {**previousTexts, **texts}
+    color = tuple(color)
+    if texts == previousTexts and color == previousColor:
+      self.avoidedRenderCount += 1
+      return
+    for position, text in texts.items():
+      if previousTexts.get(position) != text:
+        cornerAnnotation.SetText(position, text)
+    if color != previousColor:
+      cornerAnnotation.GetTextProperty().SetColor(*color)
+    self._annotationStates[cornerAnnotation] = (texts, color)
+    self.requestRender(view)
+
+  def requestRender(self, view):
+    cornerAnnotation = view.cornerAnnotation()
+    if cornerAnnotation in self._dirtyViews:
+      self.avoidedRenderCount += 1
+      return
+    self._dirtyViews[cornerAnnotation] = view
+    if not self._flushPending:
+      self._flushPending = True
+      qt.QTimer.singleShot(0, self.flush)
+
+  def flush(self):
+    dirtyViews = list(self._dirtyViews.values())
+    self._dirtyViews.clear()
+    self._flushPending = False
+    for view in dirtyViews:
+      view.scheduleRender()
+    self.renderCount += len(dirtyViews)
+
+  def reset(self):
+    """
+    Forgets the last annotation states and drops pending renders, e.g. when the scene is closed or the views are
+    recreated. A flush that is already scheduled then renders nothing.
+    """
+    self._annotationStates.clear()
+    self._dirtyViews.clear()
+
+  def resetCounters(self):
+    self.renderCount = 0
+    self.avoidedRenderCount = 0
+
+
+#
+# PointSpatialHash
+#
+
+class PointSpatialHash(VTKObservationMixin):
+  """
+  Uniform grid spatial hash of the control point positions of a markups node, for constant time proximity queries.
+  With the cell size equal to the query distance, only the 27 cells around the query point need to be checked.
+  Positions are in the local coordinate system of the markups node. Added points are inserted incrementally;
+  removed or moved points trigger a rebuild from the node, which is rare compared to queries.
+  """
+
+  MINIMUM_CELL_SIZE = 0.1  # mm
+
+  def __init__(self, cellSize=1.0):
+    VTKObservationMixin.__init__(self)
+    self.cellSize = max(float(cellSize), self.MINIMUM_CELL_SIZE)
+    self._markupsNode = None
+    self._positions = []
+    self._cells = {}  # cell index tuple -> list of positions
+
+  def __len__(self):
+    return len(self._positions)
+
+  def setMarkupsNode(self, markupsNode):
+    self.removeObservers()
+    self._markupsNode = markupsNode
+    if markupsNode is not None:
+      self.addObserver(markupsNode, slicer.vtkMRMLMarkupsNode.PointAddedEvent, self.onPointAdded)
+      for event in (slicer.vtkMRMLMarkupsNode.PointRemovedEvent, slicer.vtkMRMLMarkupsNode.PointModifiedEvent):
+        self.addObserver(markupsNode, event, self.rebuild)
+    self.rebuild()
+
+  def setCellSize(self, cellSize):
+    """
+    Re-buckets all positions with a new cell size, e.g. when the proximity threshold changes.
+    """
+    cellSize = max(float(cellSize), self.MINIMUM_CELL_SIZE)
+    if cellSize == self.cellSize:
+      return
+    self.cellSize = cellSize
+    positions = self._positions
+    self.clear()
+    for position in positions:
+      self.addPoint(position)
+
+  def clear(self):
+    self._positions = []
+    self._cells = {}
+
+  def rebuild(self, caller=None, event=None):
+    self.clear()
+    if self._markupsNode is None:
+      return
+    for pointIndex in range(self._markupsNode.GetNumberOfControlPoints()):
+      self.addPoint(self._markupsNode.GetNthControlPointPosition(pointIndex))
+
+  @vtk.calldata_type(vtk.VTK_INT)
+  def onPointAdded(self, caller, event, pointIndex):
+    # Points are normally appended. Anything else, e.g. several points added in one batch, is handled by a rebuild.
+    numberOfPoints = self._markupsNode.GetNumberOfControlPoints()
+    if pointIndex == len(self._positions) and numberOfPoints == pointIndex + 1:
+      self.addPoint(self._markupsNode.GetNthControlPointPosition(pointIndex))
+    else:
+      self.rebuild()
+
+  def _cellIndex(self, position):
+    return (int(np.floor(position[0] / self.cellSize)),
+            int(np.floor(position[1] / self.cellSize)),
+            int(np.floor(position[2] / self.cellSize)))
+
+  def addPoint(self, position):
+    position = tuple(float(x) for x in position[:3])
+    self._positions.append(position)
+    self._cells.setdefault(self._cellIndex(position), []).append(position)
+
+  def hasPointWithinDistance(self, point, distance):
+    """
+    :param point: position in the markups node coordinate system
+    :param distance: search radius (mm). Queries are constant time if this is not larger than the cell size.
+    :returns: True if any point is within the distance
+    """
+    x, y, z = (float(c) for c in point[:3])
+    i, j, k = self._cellIndex((x, y, z))
+    reach = max(1, int(np.ceil(distance / self.cellSize)))
+    distanceSquared = distance * distance
+    for di in range(-reach, reach + 1):
+      for dj in range(-reach, reach + 1):
+        for dk in range(-reach, reach + 1):
+          for px, py, pz in self._cells.get((i + di, j + dj, k + dk), ()):
+            if (px - x) ** 2 + (py - y) ** 2 + (pz - z) ** 2 <= distanceSquared:
+              return True
+    return False
+
+
+#
+# PointCoordinateMirror
+#
+
+class PointCoordinateMirror(VTKObservationMixin):
+  """
+  NumPy array of the control point positions of a markups node, in the local coordinate system of the node.
+  The array is updated incrementally from point added, removed and modified events, using the point index passed
+  with the event, and rebuilt from the node when an event has no usable index. Nearest point and radius queries
+  use a cKDTree, which is built on first query after each change.
+  """
+
+  def __init__(self):
+    VTKObservationMixin.__init__(self)
+    self._markupsNode = None
+    self._positions = np.empty((0, 3))
+    self._kdTree = None
+
+  def __len__(self):
+    return len(self._positions)
+
+  @property
+  def positions(self):
+    """
+    Read-only (N,3) array of the control point positions.
+    """
+    positions = self._positions.view()
+    positions.flags.writeable = False
+    return positions
+
+  def setMarkupsNode(self, markupsNode):
+    self.removeObservers()
+    self._markupsNode = markupsNode
+    if markupsNode is not None:
+      # Higher priority than other observers, so they always see up to date positions
+      self.addObserver(markupsNode, slicer.vtkMRMLMarkupsNode.PointAddedEvent, self.onPointAdded, priority=100.0)
+      self.addObserver(markupsNode, slicer.vtkMRMLMarkupsNode.PointRemovedEvent, self.onPointRemoved, priority=100.0)
+      for event in (slicer.vtkMRMLMarkupsNode.PointModifiedEvent, slicer.vtkMRMLMarkupsNode.PointPositionDefinedEvent):
+        self.addObserver(markupsNode, event, self.onPointModified, priority=100.0)
+    self.rebuild()
+
+  def rebuild(self, caller=None, event=None):
+    if self._markupsNode is None or self._markupsNode.GetNumberOfControlPoints() == 0:
+      self._positions = np.empty((0, 3))
+    else:
+      self._positions = slicer.util.arrayFromMarkupsControlPoints(self._markupsNode).astype(np.float64)
+    self._kdTree = None
+
+  def _getPosition(self, pointIndex):
+    position = [0.0, 0.0, 0.0]
+    self._markupsNode.GetNthControlPointPosition(pointIndex, position)
+    return position
+
+  @vtk.calldata_type(vtk.VTK_INT)
+  def onPointAdded(self, caller, event, pointIndex):
+    numberOfPoints = self._markupsNode.GetNumberOfControlPoints()
+    if pointIndex is None or numberOfPoints != len(self._positions) + 1 or not 0 <= pointIndex < numberOfPoints:
+      self.rebuild()
+      return
+    self._positions = np.insert(self._positions, pointIndex, self._getPosition(pointIndex), axis=0)
+    self._kdTree = None
+
+  @vtk.calldata_type(vtk.VTK_INT)
+  def onPointRemoved(self, caller, event, pointIndex):
+    numberOfPoints = self._markupsNode.GetNumberOfControlPoints()
+    if pointIndex is None or numberOfPoints != len(self._positions) - 1 or not 0 <= pointIndex < len(self._positions):
+      self.rebuild()
+      return
+    self._positions = np.delete(self._positions, pointIndex, axis=0)
+    self._kdTree = None
+
+  @vtk.calldata_type(vtk.VTK_INT)
+  def onPointModified(self, caller, event, pointIndex):
+    if pointIndex is None or self._markupsNode.GetNumberOfControlPoints() != len(self._positions) \
+        or not 0 <= pointIndex < len(self._positions):
+      self.rebuild()
+      return
+    self._positions[pointIndex] = self._getPosition(pointIndex)
+    self._kdTree = None
+
+  def _getKdTree(self, count):
+    # The tree covers the first count points, queries excluding the most recent points rebuild it
+    if self._kdTree is None or self._kdTree.n != count:
+      self._kdTree = cKDTree(self._positions[:count])
+    return self._kdTree
+
+  def findClosestPoint(self, point, count=None):
+    """
+    :param point: position in the markups node coordinate system
+    :param count: only search the first count points, e.g. len - 1 to skip the most recently placed one
+    :returns: (index, distance), or (None, inf) if there are no points to search
+    """
+    count = len(self._positions) if count is None else count
+    if count <= 0:
+      return None, np.inf
+    distance, index = self._getKdTree(count).query(np.asarray(point, dtype=np.float64)[:3])
+    return int(index), float(distance)
+
+  def findPointsWithinRadius(self, point, radius, count=None):
+    """
+    :param point: position in the markups node coordinate system
+    :param radius: search radius (mm)
+    :param count: only search the first count points
+    :returns: sorted list of point indices
+    """
+    count = len(self._positions) if count is None else count
+    if count <= 0:
+      return []
+    return sorted(self._getKdTree(count).query_ball_point(np.asarray(point, dtype=np.float64)[:3], radius))
+
+
+#
+# IncrementalTumorHull
+#
+
+class IncrementalTumorHull:
+  """
+  Recompute gate and coarse preview for the smoothed tumor surface. Keeps the convex hull of the tumor control
+  points, each expanded to the corners of a GLYPH_SIZE cube, updated incrementally with Qhull. Removed or moved
+  points trigger a rebuild. The smoothed surface is always the full original pipeline (glyph, vtkDelaunay3D,
+  butterfly subdivision, vtkDelaunay3D, normals) on all points. It is only recomputed when the hull changed, which
+  saves the whole pipeline run for points appended inside the hull, and nothing for other changes.
+  Skipping those points is an approximation: they are not on the hull, so the surface outline stays the same,
+  but vtkDelaunay3D could triangulate the coplanar glyph faces differently with them, and the smoothed surface
+  may then differ slightly from a full recompute until the next hull change. getSurfacePoints tells which points
+  the surface was actually computed from, so that it is only cached for those.
+  """
+
+  GLYPH_SIZE = 1.0  # mm, size of the default vtkCubeSource glyph
+  SUBDIVISIONS = 3
+  FEATURE_ANGLE = 100.0
+  INSIDE_TOLERANCE = 1e-6
+  QHULL_OPTIONS = "Q12"  # glyph corners are often coplanar, allow the resulting wide facet merges
+
+  def __init__(self):
+    self._points = np.empty((0, 3))
+    self._hull = None
+    self._surface = None
+    self._surfacePoints = None
+    self._surfaceVersion = 0  # incremented when the surface must be recomputed
+
+  @classmethod
+  def glyphCorners(cls, points):
+    offsets = (np.array(np.meshgrid([-1, 1], [-1, 1], [-1, 1], indexing="ij")).reshape(3, -1).T
+               * cls.GLYPH_SIZE / 2.0)
+    return (np.asarray(points, dtype=np.float64)[:, np.newaxis, :] + offsets).reshape(-1, 3)
+
+  def reset(self):
+    self._points = np.empty((0, 3))
+    self._hull = None
+    self._surface = None
+    self._surfacePoints = None
+    self._surfaceVersion += 1
+
+  def update(self, points):
+    """
+    :param points: (N,3) array of all tumor control point positions
+    :returns: True if the hull changed
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    if len(points) == 0:
+      changed = self._hull is not None
+      self.reset()
+      return changed
+    previousPoints = self._points
+    self._points = points.copy()
+    appended = (self._hull is not None and len(points) >= len(previousPoints)
+                and np.array_equal(points[:len(previousPoints)], previousPoints))
+    if not appended:
+      self._hull = ConvexHull(self.glyphCorners(points), incremental=True, qhull_options=self.QHULL_OPTIONS)
+      self._surface = None
+      self._surfaceVersion += 1
+      return True
+
+    corners = self.glyphCorners(points[len(previousPoints):])
+    if len(corners) == 0:
+      return False
+    equations = self._hull.equations
+    outside = np.any(corners @ equations[:, :3].T + equations[:, 3] > self.INSIDE_TOLERANCE, axis=1)
+    if not np.any(outside):
+      return False
+    self._hull.add_points(corners[outside])
+    self._surface = None
+    self._surfaceVersion += 1
+    return True
+
+  @staticmethod
+  def hullToPolyData(hull):
+    """
+    :returns: vtkPolyData of the hull triangles, oriented with outward normals
+    """
+    vertexIds = hull.vertices
+    pointIndex = np.full(len(hull.points), -1)
+    pointIndex[vertexIds] = np.arange(len(vertexIds))
+    triangles = hull.simplices.copy()
+    corners = hull.points[triangles]
+    facetNormals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    flipped = np.einsum("ij,ij->i", facetNormals, hull.equations[:, :3]) < 0
+    triangles[flipped] = triangles[flipped][:, ::-1]
+
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(hull.points[vertexIds], deep=True))
+    cells = np.hstack((np.full((len(triangles), 1), 3), pointIndex[triangles])).astype(np.int64).ravel()
+    polys = vtk.vtkCellArray()
+    polys.SetCells(len(triangles), numpy_support.numpy_to_vtkIdTypeArray(cells, deep=True))
+    polyData = vtk.vtkPolyData()
+    polyData.SetPoints(points)
+    polyData.SetPolys(polys)
+    return polyData
+
+  def getHullPolyData(self):
+    """
+    :returns: vtkPolyData of the current hull without smoothing, or None if there are no points
+    """
+    if self._hull is None:
+      return None
+    return self.hullToPolyData(self._hull)
+
+  def getSurface(self):
+    """
+    :returns: smoothed tumor surface as vtkPolyData, or None if there are no points. Only computed after the hull
+      changed, from the points at that time.
+    """
+    for _ in self.computeSurfaceSteps():
+      pass
+    return self._surface
+
+  def computeSurfaceSteps(self):
+    """
+    Computes the smoothed surface one pipeline stage at a time, so the caller can handle other events between stages.
+    Yields after each stage. When the iteration ends, the surface is returned by getSurface. A hull change while
+    iterating makes the result stale, and it is discarded.
+    """
+    if self._hull is None or self._surface is not None:
+      return
+    points = self._points.copy()
+    surfaceVersion = self._surfaceVersion
+
+    # The smoothed surface depends on how vtkDelaunay3D triangulates the coplanar glyph corners, and the second
+    # vtkDelaunay3D does not return the exact convex hull of the subdivided points. Smoothing the Qhull hull instead
+    # changed the surface by up to 1-4 mm, so the original pipeline is kept for the same tumor shape.
+    vtkPoints = vtk.vtkPoints()
+    vtkPoints.SetData(numpy_support.numpy_to_vtk(points.astype(np.float32), deep=True))  # vtkPoints default type
+    pointPolyData = vtk.vtkPolyData()
+    pointPolyData.SetPoints(vtkPoints)
+
+    glyph = vtk.vtkGlyph3D()
+    glyph.SetInputData(pointPolyData)
+    cube = vtk.vtkCubeSource()
+    cube.SetXLength(self.GLYPH_SIZE)
+    cube.SetYLength(self.GLYPH_SIZE)
+    cube.SetZLength(self.GLYPH_SIZE)
+    glyph.SetSourceConnection(cube.GetOutputPort())
+    delaunay = vtk.vtkDelaunay3D()
+    delaunay.SetInputConnection(glyph.GetOutputPort())
+    surfaceFilter = vtk.vtkDataSetSurfaceFilter()
+    surfaceFilter.SetInputConnection(delaunay.GetOutputPort())
+    surfaceFilter.Update()
+    yield
+
+    smoother = vtk.vtkButterflySubdivisionFilter()
+    smoother.SetInputConnection(surfaceFilter.GetOutputPort())
+    smoother.SetNumberOfSubdivisions(self.SUBDIVISIONS)
+    smoother.Update()
+    yield
+
+    delaunaySmooth = vtk.vtkDelaunay3D()
+    delaunaySmooth.SetInputData(smoother.GetOutput())
+    smoothSurfaceFilter = vtk.vtkDataSetSurfaceFilter()
+    smoothSurfaceFilter.SetInputConnection(delaunaySmooth.GetOutputPort())
+    smoothSurfaceFilter.Update()
+    yield
+
+    normals = vtk.vtkPolyDataNormals()
+    normals.SetInputConnection(smoothSurfaceFilter.GetOutputPort())
+    normals.SetFeatureAngle(self.FEATURE_ANGLE)
+    normals.Update()
+    if surfaceVersion == self._surfaceVersion:
+      self._surface = normals.GetOutput()
+      self._surfacePoints = points
+
+  def getSurfacePoints(self):
+    """
+    :returns: (N,3) array of the control points the current smoothed surface was computed from, or None. Differs from
+      the latest points when appended points inside the hull skipped the recompute.
+    """
+    return self._surfacePoints
+
+
+#
+# TumorSurfaceWorker
+#
+
+class TumorSurfaceWorker:
+  """
+  Computes the tumor surface from snapshots of the control point positions without blocking the GUI for the whole
+  pipeline. The pipeline runs on the main thread one stage per timer step (see IncrementalTumorHull.computeSurfaceSteps),
+  so tracking and breach warning callbacks run between stages. A background thread would not help: the VTK Python
+  wrappers hold the GIL during Update(), so callbacks would wait for the whole pipeline. The longest wait is now the
+  longest single stage, which BenchmarkGeometryPipelines.py reports per stage.
+  Only the latest request counts: a request submitted while another one is in progress replaces it, and the stages
+  already run for the superseded request are dropped. resultCallback swaps the result into the tumor model. Until
+  then the tumor model, and the breach warning node watching it, keep the previous surface.
+  """
+
+  STEP_INTERVAL_MS = 0
+
+  def __init__(self, resultCallback):
+    """
+    :param resultCallback: called on the main thread with (surface vtkPolyData, hullChanged bool, points array).
+      The points are the ones the surface was computed from, not the requested ones if the recompute was skipped.
+    """
+    self.resultCallback = resultCallback
+    self.droppedRequestCount = 0
+    self._hull = IncrementalTumorHull()
+    self._requestPoints = None
+    self._hullChanged = False
+    self._steps = None  # stage iterator of the request in progress
+
+    self._stepTimer = qt.QTimer()
+    self._stepTimer.setInterval(self.STEP_INTERVAL_MS)
+    self._stepTimer.setSingleShot(False)
+    self._stepTimer.connect('timeout()', self.step)
+
+  def submit(self, points):
+    """
+    Requests a surface for a snapshot of the control point positions.
+    :param points: (N,3) array of all tumor control point positions
+    """
+    if self._requestPoints is not None:
+      self.droppedRequestCount += 1
+    self._requestPoints = np.array(points, dtype=np.float64).reshape(-1, 3)
+    self._steps = None
+    if not self._stepTimer.isActive():
+      self._stepTimer.start()
+
+  def cancel(self):
+    """
+    Drops the request in progress, e.g. when the points changed since.
+    """
+    if self._requestPoints is not None:
+      self.droppedRequestCount += 1
+    self._finish()
+
+  def isIdle(self):
+    return self._requestPoints is None
+
+  def step(self):
+    """
+    Runs the next stage of the request in progress, and passes the surface to resultCallback after the last one.
+    Called on the main thread by the step timer.
+    """
+    if self._requestPoints is None:
+      self._stepTimer.stop()
+      return
+    try:
+      if self._steps is None:
+        self._hullChanged = self._hull.update(self._requestPoints)
+        self._steps = self._hull.computeSurfaceSteps()
+        return
+      next(self._steps)
+      return
+    except StopIteration:
+      surface, points = self._hull.getSurface(), self._hull.getSurfacePoints()
+    except Exception as e:
+      logging.error(f"Failed to compute tumor surface: {e}")
+      self._hull.reset()
+      surface, points = None, None
+    hullChanged = self._hullChanged
+    self._finish()
+    if surface is not None:
+      self.resultCallback(surface, hullChanged, points)
+
+  def waitForResult(self):
+    """
+    Runs all remaining stages of the request in progress and delivers the result, e.g. for scripted use.
+    """
+    while self._requestPoints is not None:
+      self.step()
+
+  def stop(self):
+    self._finish()
+
+  def _finish(self):
+    self._stepTimer.stop()
+    self._requestPoints = None
+    self._steps = None
+
+
+#
+# TumorSurfaceCache
+#
+
+class TumorSurfaceCache:
+  """
+  Bounded LRU cache of smooth tumor surfaces, keyed by a hash of the control point set. Coordinates are quantized
+  to QUANTIZATION_MM, deduplicated and sorted, so the key does not depend on point order or repeated points.
+  When a previous point set comes back (undo, erase, redo) its surface is restored without recomputation.
+  The least recently used surfaces are evicted when there are more than maximumEntries or when their total size
+  exceeds maximumMemoryMb. A surface shared by several point sets is counted once per entry.
+  Cached surfaces must not be modified.
+  """
+
+  QUANTIZATION_MM = 0.01
+  MAXIMUM_ENTRIES_DEFAULT = 32
+  MAXIMUM_MEMORY_MB_DEFAULT = 64
+
+  def __init__(self, maximumEntries=MAXIMUM_ENTRIES_DEFAULT, maximumMemoryMb=MAXIMUM_MEMORY_MB_DEFAULT):
+    self.maximumEntries = maximumEntries
+    self.maximumMemoryMb = maximumMemoryMb
+    self.hits = 0
+    self.misses = 0
+    self._entries = collections.OrderedDict()  # key -> (surface, memory size in KiB)
+    self._memoryKiB = 0
+
+  def __len__(self):
+    return len(self._entries)
+
+  @classmethod
+  def pointSetKey(cls, points):
+    quantized = np.round(np.asarray(points, dtype=np.float64).reshape(-1, 3) / cls.QUANTIZATION_MM).astype(np.int64)
+    quantized = np.unique(quantized, axis=0)  # sorted rows
+    return hashlib.sha1(quantized.tobytes()).hexdigest()
+
+  def get(self, points):
+    """
+    :returns: cached vtkPolyData for the point set, or None
+    """
+    key = self.pointSetKey(points)
+    entry = self._entries.get(key)
+    if entry is None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    self._entries.move_to_end(key)
+    return entry[0]
+
+  def put(self, points, surface):
+    key = self.pointSetKey(points)
+    if key in self._entries:
+      self._memoryKiB -= self._entries.pop(key)[1]
+    memoryKiB = surface.GetActualMemorySize()
+    self._entries[key] = (surface, memoryKiB)
+    self._memoryKiB += memoryKiB
+    while self._entries and (len(self._entries) > self.maximumEntries
+                             or self._memoryKiB > self.maximumMemoryMb * 1024):
+      _, (_, evictedKiB) = self._entries.popitem(last=False)
+      self._memoryKiB -= evictedKiB
+
+  def clear(self):
+    self._entries.clear()
+    self._memoryKiB = 0
+
+
 #
 # LumpNav2Logic
 #
@@ -1636,6 +3284,12 @@ class LumpNav2Logic(ScriptedLoadableModuleLogic, VTKObservationMixin):
   CAUTERY_MODEL_FILENAME = "CauteryModel.stl"
   CAUTERY_MODEL_SELECTED = "LumpNav2/CauteryModelSelected"
   TUMOR_MODEL = "TumorModel"
+  ERASER_RADIUS_SETTING = "LumpNav2/EraserRadiusMm"
+  TUMOR_REFINE_DELAY_SETTING = "LumpNav2/TumorRefineDelayMs"
+  TUMOR_REFINE_DELAY_DEFAULT = 500  # Time without new tumor points before the preview is replaced by the smooth surface
+  TUMOR_SURFACE_CACHE_SIZE_SETTING = "LumpNav2/TumorSurfaceCacheSize"
+  TUMOR_SURFACE_CACHE_MEMORY_SETTING = "LumpNav2/TumorSurfaceCacheMemoryMb"
+  DILATION_SPACING_SETTING = "LumpNav2/DilationSpacingMm"  # Dilated surfaces are within about one spacing
   STICK_MODEL = "StickModel"
   WARNING_SOUND_SETTING = "LumpNav2/WarningSoundEnabled"
   BREACH_STATUS = "LumpNav2/BreachStatus"
@@ -1701,7 +3355,25 @@ class LumpNav2Logic(ScriptedLoadableModuleLogic, VTKObservationMixin):
     self.scanSaveTempFolder = None
     self.lastTime = 0
     self.lastCauteryTipRAS = np.array([0, 0, 0, 1])
-    self.positionMatrix = [[], [], [], [], [], [], [], [], [], []]
+    self.trackingData = TrackingDataBuffer()
+    self.trackingJournal = None
+    self.trackingJournalFailed = False
+    self.tumorStatisticsCache = GeometryStatisticsCache()
+    self.transformCache = TransformCache()
+    self.renderScheduler = ViewRenderScheduler()
+    self.breachMarkupsIndex = PointSpatialHash()
+    self.breachMarkupsProximityThreshold = 1
+    self.marginDistanceEvaluator = MarginDistanceEvaluator()
+    self.tumorSurfaceWorker = TumorSurfaceWorker(self.onTumorSurfaceComputed)
+    self.tumorPreviewHull = IncrementalTumorHull()
+    self.tumorMarkupsMirror = PointCoordinateMirror()
+    self.tumorMarkupsBatchEditDepth = 0
+    self.tumorSurfaceCache = TumorSurfaceCache(
+      slicer.util.settingsValue(self.TUMOR_SURFACE_CACHE_SIZE_SETTING, TumorSurfaceCache.MAXIMUM_ENTRIES_DEFAULT, converter=int),
+      slicer.util.settingsValue(self.TUMOR_SURFACE_CACHE_MEMORY_SETTING, TumorSurfaceCache.MAXIMUM_MEMORY_MB_DEFAULT, converter=float))
+    self.tumorRefineTimer = qt.QTimer()
+    self.tumorRefineTimer.setSingleShot(True)
+    self.tumorRefineTimer.connect('timeout()', self.refineTumorSurface)
     self.updateRecordingTimeCallback = None
 
     self.predictionStarted = False
@@ -1963,10 +3635,7 @@ class LumpNav2Logic(ScriptedLoadableModuleLogic, VTKObservationMixin):
       tumorMarkups_Needle.GetDisplayNode().VisibilityOff()
       parameterNode.SetNodeReferenceID(self.TUMOR_MARKUPS_NEEDLE, tumorMarkups_Needle.GetID())
     tumorMarkups_Needle.SetAndObserveTransformNodeID(needleToReference.GetID())
-    self.removeObservers(method=self.onTumorMarkupsNodeModified)
-    self.addObserver(tumorMarkups_Needle, slicer.vtkMRMLMarkupsNode.PointPositionDefinedEvent, self.modifyPoints)
-    self.addObserver(tumorMarkups_Needle, slicer.vtkMRMLMarkupsNode.PointRemovedEvent, self.onTumorMarkupsNodeModified)
-    self.addObserver(tumorMarkups_Needle, slicer.vtkMRMLMarkupsNode.PointPositionDefinedEvent, self.onTumorMarkupsNodeModified)
+    self.observeTumorMarkups(tumorMarkups_Needle)
 
     parameterNode.SetNodeReferenceID(self.TUMOR_MARKUPS_NEEDLE, tumorMarkups_Needle.GetID())
 
@@ -2139,6 +3808,9 @@ class LumpNav2Logic(ScriptedLoadableModuleLogic, VTKObservationMixin):
       breachMarkups_Needle.SetDisplayVisibility(breachMarkupsDisplay)
       parameterNode.SetNodeReferenceID(self.BREACH_MARKUPS_NEEDLE, breachMarkups_Needle.GetID())
     breachMarkups_Needle.SetAndObserveTransformNodeID(needleToReference.GetID())
+    breachMarkupsProximityThreshold = slicer.util.settingsValue(self.BREACH_MARKUPS_PROXIMITY_THRESHOLD, 1, converter=lambda x: int(x))
+    self.setBreachMarkupsProximityThreshold(breachMarkupsProximityThreshold)
+    self.breachMarkupsIndex.setMarkupsNode(breachMarkups_Needle)
     parameterNode.SetParameter(self.BREACH_STATUS, "False")
 
     cauteryCameraToCautery = parameterNode.GetNodeReference(self.CAUTERYCAMERA_TO_CAUTERY)
@@ -2290,6 +3962,9 @@ class LumpNav2Logic(ScriptedLoadableModuleLogic, VTKObservationMixin):
       parameterNode.SetNodeReferenceID(self.CAUTERYTIP_TO_CAUTERY, cauteryTipToCautery.GetID())
     cauteryTipToCautery.SetAndObserveTransformNodeID(cauteryToReference.GetID())
 
+    # Share resolved cautery and needle transforms between callbacks of the same tracking update
+    self.transformCache.setTransformNodes(cauteryTipToCautery, needleToReference)
+
     # add observer for cautery position data recording
     self.addObserver(cauteryTipToCautery, slicer.vtkMRMLLinearTransformNode.TransformModifiedEvent, self.onTrackingDataModified)
 
@@ -2414,66 +4089,48 @@ class LumpNav2Logic(ScriptedLoadableModuleLogic, VTKObservationMixin):
         if self.updateRecordingTimeCallback:
           self.updateRecordingTimeCallback(str(currentTime))
 
-        # get cautery tip position in RAS
-        cauteryTipToCautery = parameterNode.GetNodeReference(self.CAUTERYTIP_TO_CAUTERY)
-        cauteryTipToRASMatrix = vtk.vtkMatrix4x4()
-        cauteryTipToCautery.GetMatrixTransformToWorld(cauteryTipToRASMatrix)
-        cauteryTipRAS = cauteryTipToRASMatrix.MultiplyFloatPoint([0, 0, 0, 1])
-        cauteryTipRAS = np.array(cauteryTipRAS)
-        
+        # get cautery tip position in RAS and in needle coordinates
+        cauteryTipToRASMatrix, cauteryTipToNeedleMatrix, _ = self.transformCache.getMatrices()
+        cauteryTipRAS = cauteryTipToRASMatrix[:, 3]
+        cauteryTipNeedle = cauteryTipToNeedleMatrix[:, 3]
+
         # get distance travelled by cautery
         cauteryTravelDistance = np.linalg.norm(cauteryTipRAS - self.lastCauteryTipRAS)
         cauterySpeed = cauteryTravelDistance / (currentTime - self.lastTime)
 
-        # get tip position in needle coordinate
-        needleToReference = parameterNode.GetNodeReference(self.NEEDLE_TO_REFERENCE)
-        cauteryTipToNeedleMatrix = vtk.vtkMatrix4x4()
-        cauteryTipToCautery.GetMatrixTransformToNode(needleToReference, cauteryTipToNeedleMatrix)
-        cauteryTipNeedle = cauteryTipToNeedleMatrix.MultiplyFloatPoint([0, 0, 0, 1])
-        cauteryTipNeedle = np.array(cauteryTipNeedle)
-
-        # get distance to tumor
+        # get distance to tumor, and to each margin shell as an offset of the same distance
         breachWarningNode = parameterNode.GetNodeReference(self.BREACH_WARNING)
         distanceToTumor = breachWarningNode.GetClosestDistanceToModelFromToolTip()
+        marginSizes, marginDistances = self.marginDistanceEvaluator.getDistances(
+          breachWarningNode.GetWatchedModelNode(), cauteryTipNeedle[:3], tumorDistances=distanceToTumor)
 
         # get tumor center in RAS and tumor model range
         tumorModel = parameterNode.GetNodeReference(self.TUMOR_MODEL)
-        polydata = tumorModel.GetPolyData()
-        if polydata:
-          points = polydata.GetPoints()
-          numPoints = points.GetNumberOfPoints()
-
-          # Convert points to NumPy array and change from LPS to RAS by negating the X and Y coordinates
-          coords = np.array([(-points.GetPoint(i)[0], -points.GetPoint(i)[1], points.GetPoint(i)[2]) for i in range(numPoints)])
-          center = np.array2string(np.mean(coords, axis=0))
-          xRange = np.max(coords[:, 0]) - np.min(coords[:, 0])
-          yRange = np.max(coords[:, 1]) - np.min(coords[:, 1])
-          zRange = np.max(coords[:, 2]) - np.min(coords[:, 2])
-          tumorRange = np.array2string(np.array([xRange, yRange, zRange]))
-        else:
-          center = ""
-          tumorRange = ""
+        center, tumorRange = self.tumorStatisticsCache.getCenterAndExtent(tumorModel)
 
         # add iknife data if it exists
-        scanMetadata = parameterNode.GetNodeReference(self.IKNIFE_METADATA)
+        iKnifeMetadataNode = parameterNode.GetNodeReference(self.IKNIFE_METADATA)
         try:
           scanMetadataDict = ast.literal_eval(iKnifeMetadataNode.GetText())
-          sendTime = scanMetadataDict["time"]
-          scanNumber = scanMetadataDict["scan_number"]
-          tic = scanMetadataDict["TIC"]
+          sendTime = float(scanMetadataDict["time"])
+          scanNumber = int(scanMetadataDict["scan_number"])
+          tic = int(scanMetadataDict["TIC"])
         except:
-          sendTime = ""
-          scanNumber = ""
-          tic = ""
-
-        # add data to list
-        currentTimeWorld = time.strftime("%Y-%m-%d %H:%M:%S")
-        currentData = [[currentTimeWorld], [currentTime], [sendTime], [scanNumber], 
-                       [np.array2string(cauteryTipNeedle[:3])], [distanceToTumor], 
-                       [cauterySpeed], [center], [tumorRange], [tic]]
-        self.positionMatrix = np.append(self.positionMatrix, currentData, axis=1)
+          sendTime = None
+          scanNumber = None
+          tic = None
+
+        # add data to tracking log and crash-safe journal
+        row = dict(
+          localTime=time.time(), time=currentTime, sendTime=sendTime, scanNumber=scanNumber,
+          tipNeedle=cauteryTipNeedle[:3], distance=distanceToTumor, speed=cauterySpeed,
+          tumorCenter=center, tumorExtent=tumorRange, tic=tic,
+          marginSizes=marginSizes[0], marginDistances=marginDistances[0]
+        )
+        self.trackingData.append(**row)
         self.lastTime = currentTime
         self.lastCauteryTipRAS = cauteryTipRAS
+        self.appendToTrackingJournal(row)
 
   def onIKnifeScanModified(self, caller=None, event=None):
     parameterNode = self.getParameterNode()
@@ -2488,13 +4145,214 @@ class LumpNav2Logic(ScriptedLoadableModuleLogic, VTKObservationMixin):
     np.savez(scanSavePath, peaks=peaks, metadata=scanMetadataDict)
 
   def exportTrackingDataToCsv(self, csvFilePath):
-    df = pd.DataFrame(
-      self.positionMatrix, 
-      ["Local Time", "Time (s)", "Scan Send Time", "Scan Number", "Cautery Tip Needle", 
-       "Distance To Tumour (mm)", "Cautery Speed (mm/s)", "Tumor Center", "Tumor Dimensions", "TIC"]
-    ).T
+    df = self.trackingData.toDataFrame()
     df.to_csv(csvFilePath, index=False)
 
+  def startTrackingJournal(self):
+    """
+    Starts writing tracking log rows to a journal file in the save folder.
+    """
+    saveFolder = slicer.util.settingsValue(self.SAVE_FOLDER_SETTING, os.path.dirname(slicer.util.modulePath(self.moduleName)))
+    journalFilename = f"{self.moduleName}-TrackingJournal-{time.strftime('%Y%m%d-%H%M%S')}{TrackingDataJournal.FILE_EXTENSION}"
+    journalPath = os.path.join(saveFolder, journalFilename)
+    self.trackingJournal = TrackingDataJournal(journalPath)
+    logging.info(f"Writing tracking journal to: {journalPath}")
+
+  def appendToTrackingJournal(self, row):
+    """
+    Adds a tracking log row to the journal, starting the journal on the first row. If the journal cannot be
+    written, logs one warning and stops journaling for the session. The in-memory tracking log is not affected.
+    :param row: dict, column name to value, same keys as TrackingDataBuffer.append
+    """
+    if self.trackingJournalFailed:
+      return
+    try:
+      if self.trackingJournal is None:
+        self.startTrackingJournal()
+      self.trackingJournal.append(row)
+    except Exception as e:
+      self.disableTrackingJournal(e)
+
+  def disableTrackingJournal(self, error):
+    """
+    Stops journaling for the session after an error. The journal is closed, so its writer thread and flush timer stop.
+    """
+    logging.warning(f"Tracking journal disabled for this session: {error}")
+    self.trackingJournalFailed = True
+    self.closeTrackingJournal()
+
+  def flushTrackingJournal(self):
+    """
+    Writes all queued tracking journal rows to disk.
+    :returns: str, path of the journal file, or None if no journal was started or it could not be written
+    """
+    if self.trackingJournal is None:
+      return None
+    try:
+      self.trackingJournal.flush(wait=True)
+    except Exception as e:
+      self.disableTrackingJournal(e)
+      return None
+    return self.trackingJournal.filePath
+
+  def closeTrackingJournal(self):
+    if self.trackingJournal is None:
+      return
+    try:
+      self.trackingJournal.close()
+    except Exception as e:
+      logging.warning(f"Failed to close tracking journal {self.trackingJournal.filePath}: {e}")
+    self.trackingJournal = None
+
+  @staticmethod
+  def recoverTrackingJournal(journalPath, csvFilePath=None):
+    """
+    Rebuilds the tracking log from a journal file, e.g. after a crash.
+    :param journalPath: str, path of the journal file
+    :param csvFilePath: str, optional path to write the tracking CSV to
+    :returns: pandas.DataFrame with the same columns as the tracking CSV export
+    """
+    df = TrackingDataJournal.read(journalPath).toDataFrame()
+    if csvFilePath:
+      df.to_csv(csvFilePath, index=False)
+    return df
+
+  @staticmethod
+  def getSequenceByProxyName(sequenceBrowserNode, proxyNodeName):
+    """
+    Returns the sequence node in a sequence browser whose proxy node has the specified name, or None.
+    """
+    sequenceNodes = vtk.vtkCollection()
+    sequenceBrowserNode.GetSynchronizedSequenceNodes(sequenceNodes, True)
+    for i in range(sequenceNodes.GetNumberOfItems()):
+      sequenceNode = sequenceNodes.GetItemAsObject(i)
+      proxyNode = sequenceBrowserNode.GetProxyNode(sequenceNode)
+      if proxyNode and proxyNode.GetName() == proxyNodeName:
+        return sequenceNode
+    return None
+
+  @staticmethod
+  def arrayFromTransformSequence(sequenceNode):
+    """
+    Reads all items of a linear transform sequence without changing the selected item of any browser.
+    :param sequenceNode: vtkMRMLSequenceNode of vtkMRMLLinearTransformNode items
+    :returns: (times, matrices), NumPy arrays of shape (N,) and (N, 4, 4)
+    """
+    numberOfItems = sequenceNode.GetNumberOfDataNodes()
+    times = np.empty(numberOfItems)
+    matrices = np.empty((numberOfItems, 4, 4))
+    matrix = vtk.vtkMatrix4x4()
+    for i in range(numberOfItems):
+      times[i] = float(sequenceNode.GetNthIndexValue(i))
+      sequenceNode.GetNthDataNode(i).GetMatrixTransformToParent(matrix)
+      matrices[i] = slicer.util.arrayFromVTKMatrix(matrix)
+    return times, matrices
+
+  @staticmethod
+  def resampleTransformSequence(times, matrices, sampleTimes):
+    """
+    Picks the last item at or before each sample time, like sequence browser playback does.
+    """
+    if len(times) == 0:
+      return np.broadcast_to(np.eye(4), (len(sampleTimes), 4, 4))
+    indices = np.searchsorted(times, sampleTimes, side="right") - 1
+    return matrices[np.clip(indices, 0, len(times) - 1)]
+
+  def getTrackingTrajectory(self, sequenceBrowserNode=None):
+    """
+    Computes the cautery tip trajectory of a recorded tracking sequence in one batch, without selecting items in
+    the browser (no scene updates or rendering). Needle and calibration sequences are sampled at the cautery
+    timestamps. Transforms that are not recorded in the browser are taken from the current scene.
+    :param sequenceBrowserNode: vtkMRMLSequenceBrowserNode, tracking browser by default
+    :returns: dict of NumPy arrays: "time" (N,), "cauteryTipToRas", "cauteryTipToNeedle", "needleToRas" (N, 4, 4),
+      "tipRas" and "tipNeedle" (N, 3)
+    """
+    if sequenceBrowserNode is None:
+      sequenceBrowserNode = self.getParameterNode().GetNodeReference(self.TRACKING_SEQUENCE_BROWSER)
+
+    cauterySequence = self.getSequenceByProxyName(sequenceBrowserNode, self.CAUTERY_TO_REFERENCE)
+    if cauterySequence is None:
+      raise ValueError(f"{sequenceBrowserNode.GetName()} has no {self.CAUTERY_TO_REFERENCE} sequence")
+    times, cauteryToReference = self.arrayFromTransformSequence(cauterySequence)
+    order = np.argsort(times, kind="stable")
+    times = times[order]
+    cauteryToReference = cauteryToReference[order]
+
+    def sampleTransform(transformName):
+      sequenceNode = self.getSequenceByProxyName(sequenceBrowserNode, transformName)
+      if sequenceNode is not None:
+        sequenceTimes, sequenceMatrices = self.arrayFromTransformSequence(sequenceNode)
+        sequenceOrder = np.argsort(sequenceTimes, kind="stable")
+        return self.resampleTransformSequence(sequenceTimes[sequenceOrder], sequenceMatrices[sequenceOrder], times)
+      transformNode = self.getParameterNode().GetNodeReference(transformName)
+      if transformNode is None:
+        transformNode = slicer.mrmlScene.GetFirstNodeByName(transformName)
+      return np.broadcast_to(slicer.util.arrayFromTransformMatrix(transformNode), (len(times), 4, 4))
+
+    needleToReference = sampleTransform(self.NEEDLE_TO_REFERENCE)
+    cauteryTipToCautery = sampleTransform(self.CAUTERYTIP_TO_CAUTERY)
+
+    # ReferenceToRas is not recorded, use the current parent of the cautery proxy node
+    referenceToRas = np.eye(4)
+    cauteryProxy = sequenceBrowserNode.GetProxyNode(cauterySequence)
+    if cauteryProxy and cauteryProxy.GetParentTransformNode():
+      referenceToRas = slicer.util.arrayFromTransformMatrix(cauteryProxy.GetParentTransformNode(), toWorld=True)
+
+    cauteryTipToReference = cauteryToReference @ cauteryTipToCautery
+    cauteryTipToRas = referenceToRas @ cauteryTipToReference
+    needleToRas = referenceToRas @ needleToReference
+    cauteryTipToNeedle = np.linalg.inv(needleToReference) @ cauteryTipToReference
+
+    return {
+      "time": times,
+      "cauteryTipToRas": cauteryTipToRas,
+      "cauteryTipToNeedle": cauteryTipToNeedle,
+      "needleToRas": needleToRas,
+      "tipRas": cauteryTipToRas[:, :3, 3],
+      "tipNeedle": cauteryTipToNeedle[:, :3, 3],
+    }
+
+  def replayTrackingData(self, sequenceBrowserNode=None):
+    """
+    Recomputes the tracking log of a recorded case in one batch, with the values that onTrackingDataModified
+    records live: cautery tip in needle coordinates, distance to the tumor and its margin shells, cautery speed,
+    tumor center and size. Local time and iKnife columns cannot be recovered from the sequences, and are left empty.
+    Limitation: the tumor model is not recorded in the sequences, so the tumor model currently in the scene is used
+    for every frame (for a saved case, the final contour). For frames recorded before later tumor edits, the tumor
+    distance, margin distances, tumor center and size differ from the values that were logged live.
+    :param sequenceBrowserNode: vtkMRMLSequenceBrowserNode, tracking browser by default
+    :returns: TrackingDataBuffer
+    """
+    trajectory = self.getTrackingTrajectory(sequenceBrowserNode)
+
+    # Live recording logs each timestamp once, and only positive timestamps
+    times, firstIndices = np.unique(trajectory["time"], return_index=True)
+    positive = times > 0
+    times = times[positive]
+    firstIndices = firstIndices[positive]
+    tipRas = trajectory["tipRas"][firstIndices]
+    tipNeedle = trajectory["tipNeedle"][firstIndices]
+
+    # Speed relative to the previous frame, the first frame is relative to the origin at time 0 as in live recording
+    previousTipRas = np.vstack((np.zeros((1, 3)), tipRas[:-1]))
+    previousTimes = np.concatenate(([0.0], times[:-1]))
+    speed = np.linalg.norm(tipRas - previousTipRas, axis=1) / (times - previousTimes)
+
+    tumorModel = self.getParameterNode().GetNodeReference(self.TUMOR_MODEL)
+    distance = np.full(len(times), np.nan)
+    # Each frame is queried once, so building a distance grid would cost more than exact evaluation
+    distanceEngine = self.marginDistanceEvaluator.getEngine(tumorModel)
+    if distanceEngine is not None:
+      distance = distanceEngine.distances(tipNeedle)
+    marginSizes, marginDistances = self.marginDistanceEvaluator.getDistances(tumorModel, tipNeedle, tumorDistances=distance)
+    center, tumorRange = self.tumorStatisticsCache.getCenterAndExtent(tumorModel)
+
+    columns = dict(time=times, tipNeedle=tipNeedle, distance=distance, speed=speed,
+                   marginSizes=marginSizes, marginDistances=marginDistances)
+    if center is not None:
+      columns.update(tumorCenter=center, tumorExtent=tumorRange)
+    return TrackingDataBuffer.fromColumns(**columns)
+
   def onUltrasoundSequenceBrowserClicked(self, toggled):
     self.setUltrasoundSequenceBrowser(toggled)
     self.setLivePrediction(toggled)
@@ -2692,42 +4550,29 @@ class LumpNav2Logic(ScriptedLoadableModuleLogic, VTKObservationMixin):
     tumorMarkups_Needle.RemoveNthControlPoint(numberOfPoints - 1)
     logging.info("Deleted last fiducial at %s", deleted_coord)
     if numberOfPoints <= 1:
-      sphereSource = vtk.vtkSphereSource()
-      sphereSource.SetRadius(0.001)
-      parameterNode = self.getParameterNode()
-      tumorModel_Needle = parameterNode.GetNodeReference(self.TUMOR_MODEL)
-      tumorModel_Needle.SetPolyDataConnection(sphereSource.GetOutputPort())
-      tumorModel_Needle.Modified()
+      self.setEmptyTumorModel()
 
   def setDeleteAllFiducialsClicked(self):
     parameterNode = self.getParameterNode()
     tumorMarkups_Needle = parameterNode.GetNodeReference(self.TUMOR_MARKUPS_NEEDLE)
     tumorMarkups_Needle.RemoveAllControlPoints()
     logging.info("Deleted all fiducials")
-
-    sphereSource = vtk.vtkSphereSource()
-    sphereSource.SetRadius(0.001)
-    tumorModel_Needle = parameterNode.GetNodeReference(self.TUMOR_MODEL)
-    tumorModel_Needle.SetPolyDataConnection(sphereSource.GetOutputPort())
-    tumorModel_Needle.Modified()
+    self.setEmptyTumorModel()
 
   def setMarkPointCauteryTipClicked(self):
     parameterNode = self.getParameterNode()
-    needleToReference = parameterNode.GetNodeReference(self.NEEDLE_TO_REFERENCE)
-    cauteryTipToNeedle = vtk.vtkMatrix4x4()
-    cauteryTipToCautery = parameterNode.GetNodeReference(self.CAUTERYTIP_TO_CAUTERY)
-    cauteryTipToCautery.GetMatrixTransformToNode(needleToReference, cauteryTipToNeedle)
+    _, cauteryTipToNeedle, _ = self.transformCache.getMatrices()
     tumorMarkups_Needle = parameterNode.GetNodeReference(self.TUMOR_MARKUPS_NEEDLE)
     tumorMarkups_Needle.AddControlPoint(
-      cauteryTipToNeedle.GetElement(0, 3),
-      cauteryTipToNeedle.GetElement(1, 3),
-      cauteryTipToNeedle.GetElement(2, 3)
+      cauteryTipToNeedle[0, 3],
+      cauteryTipToNeedle[1, 3],
+      cauteryTipToNeedle[2, 3]
     )
     logging.info(
       "Tumor point placed at cautery tip, (%s, %s, %s)",
-      cauteryTipToNeedle.GetElement(0, 3),
-      cauteryTipToNeedle.GetElement(1, 3),
-      cauteryTipToNeedle.GetElement(2, 3)
+      cauteryTipToNeedle[0, 3],
+      cauteryTipToNeedle[1, 3],
+      cauteryTipToNeedle[2, 3]
     )
 
   def setFreezeUltrasoundClicked(self, toggled):
@@ -2741,84 +4586,69 @@ class LumpNav2Logic(ScriptedLoadableModuleLogic, VTKObservationMixin):
         plusServerConnectorNode.Start()
 
   def applyDilation(self, model, dilationValue):
+    """
+    Creates the TumorModelDilate{dilationValue}mm model, the surface of the model dilated by the margin.
+    """
+    self.applyDilations(model, [dilationValue])
+
+  def applyDilations(self, model, dilationValues):
+    """
+    Creates a TumorModelDilate{N}mm model for each margin. Convex models, such as the hydromark ellipsoid, are
+    dilated exactly from their convex hull (see ConvexHullOffset). Other models and negative margins use shells
+    of the same distance map of the model (see TumorDistanceMap), so several margins cost little more than one.
+    The smoothed tumor from markups has small dents, so it is usually not convex and takes the distance map path.
+    :param model: parameter node reference of the model to dilate
+    :param dilationValues: list of margins (mm)
+    :returns: list of the created model nodes
+    """
+    if not dilationValues:
+      return []
     parameterNode = self.getParameterNode()
-    segmentationLogic = slicer.modules.segmentations.logic()
     modelNode = parameterNode.GetNodeReference(model)
-    modelNode.SetAndObserveTransformNodeID(None)  # move out of transform
-
-    # create segmentation node
-    modelSegmentation = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
-    segmentationLogic.ImportModelToSegmentationNode(modelNode, modelSegmentation)
-
-    # get coordinates of tumor center in RAS
-    centerOfMassFilter = vtk.vtkCenterOfMass()
-    centerOfMassFilter.SetInputData(modelNode.GetPolyData())
-    centerOfMassFilter.SetUseScalarsAsWeights(False)
-    centerOfMassFilter.Update()
-    center = centerOfMassFilter.GetCenter()
-
-    # create 10x10x10cm ROI around tumor center
-    roiNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsROINode")
-    roiNode.SetDisplayVisibility(False)
-    roiNode.SetXYZ(center)
-    roiNode.SetRadiusXYZ(100, 100, 100)
-
-    # set source geometry to ROI
-    segGeometryLogic = slicer.vtkSlicerSegmentationGeometryLogic()
-    segGeometryLogic.SetInputSegmentationNode(modelSegmentation)
-    segGeometryLogic.SetSourceGeometryNode(roiNode)
-    segGeometryLogic.CalculateOutputGeometry()
-    geometryImageData = segGeometryLogic.GetOutputGeometryImageData()
-
-    # get binary labelmap representation of tumor
-    segmentIds = vtk.vtkStringArray()
-    modelSegmentation.GetSegmentation().GetSegmentIDs(segmentIds)
-    segmentId = segmentIds.GetValue(0)
-    modelLabelmap = modelSegmentation.GetBinaryLabelmapInternalRepresentation(segmentId)
-    slicer.vtkOrientedImageDataResample.ResampleOrientedImageToReferenceOrientedImage(modelLabelmap, geometryImageData, modelLabelmap)
-
-    # create segment editor widget to access effects
-    segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
-    segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
-    segmentEditorNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentEditorNode")  # temp
-    segmentEditorWidget.setMRMLSegmentEditorNode(segmentEditorNode)
-    segmentEditorWidget.setSegmentationNode(modelSegmentation)
-    segmentEditorWidget.setCurrentSegmentID(segmentId)
-
-    # dilate tumor
-    segmentEditorWidget.setActiveEffectByName("Margin")
-    effect = segmentEditorWidget.activeEffect()
-    effect.setParameter("MarginSizeMm", dilationValue)
-    effect.setParameter("SelectedSegmentID", segmentId)
-    effect.self().onApply()
-
-    # get segment and convert to model
-    modelSegment = modelSegmentation.GetSegmentation().GetSegment(segmentId)
-    modelName = f"TumorModelDilate{dilationValue}mm"
-    modelSegment.SetName(modelName)
-
-    # create folder for exported segmentation
+    polyData = modelNode.GetPolyData()
+    convexOffset = ConvexHullOffset(polyData) if polyData is not None else None
+    if convexOffset is not None and convexOffset.isConvex:
+      rasterValues = [dilationValue for dilationValue in dilationValues if dilationValue <= 0]
+    else:
+      rasterValues = list(dilationValues)
+    dilatedPolyDataByValue = {}
+    if rasterValues:
+      spacing = slicer.util.settingsValue(self.DILATION_SPACING_SETTING, TumorDistanceMap.SPACING_DEFAULT, converter=float)
+      try:
+        distanceMap = TumorDistanceMap(polyData, max(rasterValues), spacing)
+      except ValueError as err:
+        logging.error(f"Cannot dilate {modelNode.GetName()}: {err}")
+        return []
+      dilatedPolyDataByValue.update(zip(rasterValues, distanceMap.extractSurfaces(rasterValues)))
+    for dilationValue in dilationValues:
+      if dilationValue not in dilatedPolyDataByValue:
+        dilatedPolyDataByValue[dilationValue] = convexOffset.offsetSurface(dilationValue)
+    dilatedPolyDatas = [dilatedPolyDataByValue[dilationValue] for dilationValue in dilationValues]
+
+    dilatedModelNodes = []
     shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-    folderItem = shNode.CreateFolderItem(shNode.GetSceneItemID(), shNode.GenerateUniqueItemName(modelName))
-    segmentationLogic.ExportSegmentsToModels(modelSegmentation, [segmentId], folderItem)
-
-    # move both tumor models back to NeedleToReference
-    dilatedModelNode = slicer.mrmlScene.GetFirstNodeByName(modelName)
-    needleToReference = parameterNode.GetNodeReference(self.NEEDLE_TO_REFERENCE)
-    modelNode.SetAndObserveTransformNodeID(needleToReference.GetID())
-    dilatedModelNode.SetAndObserveTransformNodeID(needleToReference.GetID())
-
-    # set opacity and color
-    dilatedModelDisplayNode = dilatedModelNode.GetDisplayNode()
-    dilatedModelDisplayNode.SetOpacity(0.15)
-    dilatedModelDisplayNode.SetColor(modelNode.GetDisplayNode().GetColor())
-    dilatedModelDisplayNode.Visibility2DOn()
-    dilatedModelDisplayNode.SetSliceIntersectionThickness(4)
-
-    # cleanup temporary nodes
-    slicer.mrmlScene.RemoveNode(roiNode)
-    slicer.mrmlScene.RemoveNode(modelSegmentation)
-    slicer.mrmlScene.RemoveNode(segmentEditorNode)
+    for dilationValue, dilatedPolyData in zip(dilationValues, dilatedPolyDatas):
+      # create model in a folder, as segment export did
+      modelName = f"TumorModelDilate{dilationValue}mm"
+      dilatedModelNode = slicer.modules.models.logic().AddModel(dilatedPolyData)
+      dilatedModelNode.SetName(modelName)
+      folderItem = shNode.CreateFolderItem(shNode.GetSceneItemID(), shNode.GenerateUniqueItemName(modelName))
+      shNode.SetItemParent(shNode.GetItemByDataNode(dilatedModelNode), folderItem)
+
+      # dilated model is in the coordinate system of the tumor model
+      dilatedModelNode.SetAndObserveTransformNodeID(modelNode.GetTransformNodeID())
+
+      # set opacity and color
+      dilatedModelDisplayNode = dilatedModelNode.GetDisplayNode()
+      dilatedModelDisplayNode.SetOpacity(0.15)
+      dilatedModelDisplayNode.SetColor(modelNode.GetDisplayNode().GetColor())
+      dilatedModelDisplayNode.Visibility2DOn()
+      dilatedModelDisplayNode.SetSliceIntersectionThickness(4)
+
+      # record the margin, so distances to it are added to the tracking log
+      MarginDistanceEvaluator.addMarginSize(modelNode, dilationValue)
+      dilatedModelNodes.append(dilatedModelNode)
+    return dilatedModelNodes
 
   def setPlusServerClicked(self, toggled):
     parameterNode = self.getParameterNode()
@@ -2919,7 +4749,7 @@ class LumpNav2Logic(ScriptedLoadableModuleLogic, VTKObservationMixin):
     for i in range(slicer.app.layoutManager().threeDViewCount):
       view = slicer.app.layoutManager().threeDWidget(i).threeDView()
       view.cornerAnnotation().SetLinearFontScaleFactor(fontSize)
-      view.forceRender()
+      self.renderScheduler.requestRender(view)
 
   def setBrightness(self, maxLevel):
     self.setImageMinMaxLevel(0, maxLevel)
@@ -2969,6 +4799,82 @@ class LumpNav2Logic(ScriptedLoadableModuleLogic, VTKObservationMixin):
     cmdSetParameter.ClearResponseMetaData()
     return cmdSetParameter
 
+  def observeTumorMarkups(self, tumorMarkups_Needle):
+    """
+    Observes point changes of the tumor markups to update the tumor surface. None removes the observers.
+    """
+    self.tumorMarkupsMirror.setMarkupsNode(tumorMarkups_Needle)
+    self.removeObservers(method=self.modifyPoints)
+    self.removeObservers(method=self.onTumorMarkupsNodeModified)
+    if tumorMarkups_Needle is None:
+      return
+    self.addObserver(tumorMarkups_Needle, slicer.vtkMRMLMarkupsNode.PointPositionDefinedEvent, self.modifyPoints)
+    self.addObserver(tumorMarkups_Needle, slicer.vtkMRMLMarkupsNode.PointRemovedEvent, self.onTumorMarkupsNodeModified)
+    self.addObserver(tumorMarkups_Needle, slicer.vtkMRMLMarkupsNode.PointPositionDefinedEvent, self.onTumorMarkupsNodeModified)
+
+  @contextlib.contextmanager
+  def tumorMarkupsBatchEdit(self):
+    """
+    Context for changing many tumor points at once, e.g. importing a contour or in scripted tests.
+    Tumor markups observers are suspended in the block, and the tumor surface is generated once at the end.
+    Nested batch edits generate the surface when the outermost one ends.
+    Usage:
+      with logic.tumorMarkupsBatchEdit() as tumorMarkups_Needle:
+        ...
+    """
+    parameterNode = self.getParameterNode()
+    tumorMarkups_Needle = parameterNode.GetNodeReference(self.TUMOR_MARKUPS_NEEDLE)
+    self.tumorMarkupsBatchEditDepth += 1
+    if self.tumorMarkupsBatchEditDepth == 1:
+      self.observeTumorMarkups(None)
+    try:
+      yield tumorMarkups_Needle
+    finally:
+      self.tumorMarkupsBatchEditDepth -= 1
+      if self.tumorMarkupsBatchEditDepth == 0:
+        self.observeTumorMarkups(tumorMarkups_Needle)
+        if tumorMarkups_Needle.GetNumberOfControlPoints() < 1:
+          self.setEmptyTumorModel()
+        else:
+          self.createTumorFromMarkups()
+          # No more points are coming, so skip the preview delay
+          if self.tumorRefineTimer.isActive():
+            self.tumorRefineTimer.stop()
+            self.refineTumorSurface()
+        parameterNode.Modified()
+
+  def setTumorPoints(self, points):
+    """
+    Replaces all tumor points in one array based update, and generates the tumor surface once.
+    :param points: (N,3) array of positions in Needle coordinates
+    """
+    with self.tumorMarkupsBatchEdit() as tumorMarkups_Needle:
+      slicer.util.updateMarkupsControlPointsFromArray(tumorMarkups_Needle, np.asarray(points, dtype=np.float64).reshape(-1, 3))
+    logging.info(f"Set {len(points)} tumor points")
+
+  def addTumorPoints(self, points):
+    """
+    Adds tumor points after the existing ones in one array based update, and generates the tumor surface once.
+    :param points: (N,3) array of positions in Needle coordinates
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    with self.tumorMarkupsBatchEdit() as tumorMarkups_Needle:
+      # The markups mirror is detached during batch edits, so read the existing points from the node
+      existingPoints = slicer.util.arrayFromMarkupsControlPoints(tumorMarkups_Needle).reshape(-1, 3)
+      self.setTumorPoints(np.vstack((existingPoints, points)))
+
+  def setEmptyTumorModel(self):
+    # Pending surface updates must not bring back the previous tumor
+    self.tumorRefineTimer.stop()
+    self.tumorSurfaceWorker.cancel()
+    self.tumorPreviewHull.reset()
+    sphereSource = vtk.vtkSphereSource()
+    sphereSource.SetRadius(0.001)
+    parameterNode = self.getParameterNode()
+    tumorModel_Needle = parameterNode.GetNodeReference(self.TUMOR_MODEL)
+    tumorModel_Needle.SetPolyDataConnection(sphereSource.GetOutputPort())
+    tumorModel_Needle.Modified()
+
   def onTumorMarkupsNodeModified(self, observer, eventid):
     logging.debug("onTumorMarkupsNodeModified")
     self.createTumorFromMarkups()
@@ -2976,73 +4882,67 @@ class LumpNav2Logic(ScriptedLoadableModuleLogic, VTKObservationMixin):
     parameterNode.Modified()
 
   def createTumorFromMarkups(self):
+    """
+    Updates the tumor model from the current tumor markups in two steps. The convex hull of the points is shown
+    right away as a coarse preview. When no points were placed for the refine delay, the smooth surface is computed
+    in steps between other events and replaces the preview (see refineTumorSurface).
+    """
     logging.debug('createTumorFromMarkups')
-    # Create polydata point set from markup points
-    points = vtk.vtkPoints()
-    cellArray = vtk.vtkCellArray()
     parameterNode = self.getParameterNode()
     tumorMarkups_Needle = parameterNode.GetNodeReference(self.TUMOR_MARKUPS_NEEDLE)
     numberOfPoints = tumorMarkups_Needle.GetNumberOfControlPoints()
 
     # Surface generation algorithms behave unpredictably when there are not enough points
-    # return if there are very few points
+    # keep the previous surface if there are very few points
     if numberOfPoints < 1:
-      # sphereSource = vtk.vtkSphereSource()
-      # # sphereSource.SetRadius(0.001)
-      # tumorModel_Needle = parameterNode.GetNodeReference(self.TUMOR_MODEL)
-      # tumorModel_Needle.SetPolyDataConnection(sphereSource.GetOutputPort())
-      # tumorModel_Needle.Modified()
+      self.tumorRefineTimer.stop()
+      self.tumorSurfaceWorker.cancel()
+      self.tumorPreviewHull.reset()
       return
 
-    points.SetNumberOfPoints(numberOfPoints)
-    new_coord = [0.0, 0.0, 0.0]
-    for i in range(numberOfPoints):
-      tumorMarkups_Needle.GetNthControlPointPosition(i, new_coord)
-      points.SetPoint(i, new_coord)
-
-    tumorMarkups_Needle.GetNthControlPointPosition(numberOfPoints - 1, new_coord)
-    logging.info("Placed point at position: %s", new_coord)
-
-    cellArray.InsertNextCell(numberOfPoints)
-    for i in range(numberOfPoints):
-      cellArray.InsertCellPoint(i)
-    pointPolyData = vtk.vtkPolyData()
-    pointPolyData.SetLines(cellArray)
-    pointPolyData.SetPoints(points)
-
-    delaunay = vtk.vtkDelaunay3D()
-
-    logging.debug("use glyphs")
-    sphere = vtk.vtkCubeSource()
-    glyph = vtk.vtkGlyph3D()
-    glyph.SetInputData(pointPolyData)
-    glyph.SetSourceConnection(sphere.GetOutputPort())
-    delaunay.SetInputConnection(glyph.GetOutputPort())
-
-    delaunay.Update()
-    surfaceFilter = vtk.vtkDataSetSurfaceFilter()
-    surfaceFilter.SetInputConnection(delaunay.GetOutputPort())
+    controlPoints = slicer.util.arrayFromMarkupsControlPoints(tumorMarkups_Needle)
+    logging.info("Placed point at position: %s", controlPoints[-1])
 
-    smoother = vtk.vtkButterflySubdivisionFilter()
-    smoother.SetInputConnection(surfaceFilter.GetOutputPort())
-    smoother.SetNumberOfSubdivisions(3)
-    smoother.Update()
+    # Point sets that were meshed before, e.g. after undo or erase, get their smooth surface back right away
+    tumorModel_Needle = parameterNode.GetNodeReference(self.TUMOR_MODEL)
+    hullChanged = self.tumorPreviewHull.update(controlPoints)
+    cachedSurface = self.tumorSurfaceCache.get(controlPoints)
+    if cachedSurface is not None:
+      self.tumorRefineTimer.stop()
+      self.tumorSurfaceWorker.cancel()
+      if tumorModel_Needle.GetPolyData() is not cachedSurface:
+        tumorModel_Needle.SetAndObservePolyData(cachedSurface)
+      return
 
-    delaunaySmooth = vtk.vtkDelaunay3D()
-    delaunaySmooth.SetInputData(smoother.GetOutput())
-    delaunaySmooth.Update()
+    # Points inside the current hull do not change the preview, and do not trigger a recompute of the smooth surface
+    if hullChanged:
+      self.tumorSurfaceWorker.cancel()
+      tumorModel_Needle.SetAndObservePolyData(self.tumorPreviewHull.getHullPolyData())
 
-    smoothSurfaceFilter = vtk.vtkDataSetSurfaceFilter()
-    smoothSurfaceFilter.SetInputConnection(delaunaySmooth.GetOutputPort())
+    refineDelayMs = slicer.util.settingsValue(self.TUMOR_REFINE_DELAY_SETTING, self.TUMOR_REFINE_DELAY_DEFAULT, converter=int)
+    self.tumorRefineTimer.start(refineDelayMs)
 
-    normals = vtk.vtkPolyDataNormals()
-    normals.SetInputConnection(smoothSurfaceFilter.GetOutputPort())
-    normals.SetFeatureAngle(100.0)
+  def refineTumorSurface(self):
+    """
+    Requests the smooth tumor surface for the current tumor markups. The surface is computed one pipeline stage per
+    timer step by TumorSurfaceWorker, and the tumor model is updated by onTumorSurfaceComputed.
+    """
+    parameterNode = self.getParameterNode()
+    tumorMarkups_Needle = parameterNode.GetNodeReference(self.TUMOR_MARKUPS_NEEDLE)
+    if tumorMarkups_Needle is None or tumorMarkups_Needle.GetNumberOfControlPoints() < 1:
+      return
+    self.tumorSurfaceWorker.submit(slicer.util.arrayFromMarkupsControlPoints(tumorMarkups_Needle))
 
-    normals.Update()
+  def onTumorSurfaceComputed(self, surface, hullChanged, points):
+    # Cached only for the points it was computed from: a surface reused for appended points inside the hull is not
+    # exactly what a full recompute would give for them
+    self.tumorSurfaceCache.put(points, surface)
     parameterNode = self.getParameterNode()
     tumorModel_Needle = parameterNode.GetNodeReference(self.TUMOR_MODEL)
-    tumorModel_Needle.SetAndObservePolyData(normals.GetOutput())
+    if tumorModel_Needle is None or (not hullChanged and tumorModel_Needle.GetPolyData() is surface):
+      return
+    tumorModel_Needle.SetAndObservePolyData(surface)
+    parameterNode.Modified()
 
   def setMarkPoints(self, toggled):
     parameterNode = self.getParameterNode()
@@ -3078,29 +4978,30 @@ class LumpNav2Logic(ScriptedLoadableModuleLogic, VTKObservationMixin):
     parameterNode = self.getParameterNode()
     tumorMarkups_Needle = parameterNode.GetNodeReference(self.TUMOR_MARKUPS_NEEDLE)
     if parameterNode.GetParameter(self.POINTS_STATUS) == self.POINTS_ERASING:
+      # The most recently placed point marks the eraser position, and is removed with the erased points
       numberOfPoints = tumorMarkups_Needle.GetNumberOfControlPoints()
-      mostRecentPoint = [0.0, 0.0, 0.0]
-      tumorMarkups_Needle.GetNthControlPointPosition(numberOfPoints - 1, mostRecentPoint)
-      closestPoint, closestPointPosition = self.returnClosestPoint(tumorMarkups_Needle, mostRecentPoint)
-      tumorMarkups_Needle.RemoveNthControlPoint(closestPoint)
-      tumorMarkups_Needle.RemoveNthControlPoint(tumorMarkups_Needle.GetNumberOfControlPoints() - 1)
-      logging.info("Used eraser to remove point at %s", closestPointPosition)
-      self.createTumorFromMarkups()
+      eraserPosition = self.tumorMarkupsMirror.positions[numberOfPoints - 1].copy()
+      eraserRadius = slicer.util.settingsValue(self.ERASER_RADIUS_SETTING, 0, converter=float)
+      if eraserRadius > 0:
+        erasedPoints = self.tumorMarkupsMirror.findPointsWithinRadius(eraserPosition, eraserRadius, count=numberOfPoints - 1)
+      elif numberOfPoints > 1:
+        erasedPoints = [self.returnClosestPoint(tumorMarkups_Needle, eraserPosition)[0]]
+      else:
+        erasedPoints = []
+      erasedPositions = self.tumorMarkupsMirror.positions[erasedPoints].tolist()
+      # Observers are suspended while removing, so the tumor surface is generated once instead of for each point
+      with self.tumorMarkupsBatchEdit():
+        for pointIndex in [numberOfPoints - 1] + sorted(erasedPoints, reverse=True):
+          tumorMarkups_Needle.RemoveNthControlPoint(pointIndex)
+      logging.info("Used eraser to remove points at %s", erasedPositions)
 
   def returnClosestPoint(self, fiducialNode, erasePoint):
-    # Returns closest marked point to where eraser fiducial was placed
-    closestIndex = 0
-    distanceToClosest = np.inf
-    fiducialPosition = [0.0, 0.0, 0.0]
-    numberOfPoints = fiducialNode.GetNumberOfControlPoints()
-    for fiducialIndex in range(numberOfPoints - 1):
-      fiducialNode.GetNthControlPointPosition(fiducialIndex, fiducialPosition)
-      distanceToPoint = self.calculateDistance(fiducialPosition, erasePoint)
-      if distanceToPoint < distanceToClosest:
-        closestIndex = fiducialIndex
-        distanceToClosest = distanceToPoint
-    fiducialNode.GetNthControlPointPosition(closestIndex, fiducialPosition)
-    return closestIndex, fiducialPosition
+    # Returns closest marked point to where eraser fiducial was placed, skipping the eraser fiducial (last point).
+    # Positions are looked up in the tumor markups mirror, so fiducialNode must be the tumor markups node.
+    closestIndex, _ = self.tumorMarkupsMirror.findClosestPoint(erasePoint, count=fiducialNode.GetNumberOfControlPoints() - 1)
+    if closestIndex is None:
+      closestIndex = 0
+    return closestIndex, self.tumorMarkupsMirror.positions[closestIndex].tolist()
 
   def setPlaceHydromark(self, toggled):
     parameterNode = self.getParameterNode()
@@ -3226,59 +5127,40 @@ class LumpNav2Logic(ScriptedLoadableModuleLogic, VTKObservationMixin):
     breachWarningNode = parameterNode.GetNodeReference(self.BREACH_WARNING)
     distance = breachWarningNode.GetClosestDistanceToModelFromToolTip()
 
-    # Display breach warning text in corner of view
+    # Display breach warning text in corner of view. Only views where the text or color changed are rendered.
+    breached = distance < 0
+    distanceText = distance if distance >= 0 else 0
+    texts = {
+      vtk.vtkCornerAnnotation.UpperLeft: f"{distanceText:.0f}mm",
+      vtk.vtkCornerAnnotation.LowerLeft: "BREACH!" if breached else "",
+    }
+    color = (1, 0, 0) if breached else (0, 0, 0.5)  # red or blue
     for i in range(slicer.app.layoutManager().threeDViewCount):
       view = slicer.app.layoutManager().threeDWidget(i).threeDView()
-      distanceText = distance if distance >= 0 else 0
-      view.cornerAnnotation().SetText(vtk.vtkCornerAnnotation.UpperLeft, f"{distanceText:.0f}mm")
-      textProperty = view.cornerAnnotation().GetTextProperty()
-      textProperty.SetColor(0, 0, 0.5)  # blue
-      view.forceRender()
-    
-    if breachWarningNode.GetClosestDistanceToModelFromToolTip() < 0:
-      for i in range(slicer.app.layoutManager().threeDViewCount):
-        view = slicer.app.layoutManager().threeDWidget(i).threeDView()
-        view.cornerAnnotation().SetText(vtk.vtkCornerAnnotation.LowerLeft, "BREACH!")
-        textProperty = view.cornerAnnotation().GetTextProperty()
-        textProperty.SetColor(1, 0, 0)  # red
-        view.forceRender()
+      self.renderScheduler.setCornerAnnotation(view, texts, color)
 
+    if breached:
       # Add breach event to event table
       if parameterNode.GetParameter(self.BREACH_STATUS) == "False":
         self.addEvent(description="Tumor margin breach")
         parameterNode.SetParameter(self.BREACH_STATUS, "True")
 
       # Get coordinate of cautery tip in needle coordinate system
-      needleToReference = parameterNode.GetNodeReference(self.NEEDLE_TO_REFERENCE)
-      cauteryTipToNeedle = vtk.vtkMatrix4x4()
-      cauteryTipToCautery = parameterNode.GetNodeReference(self.CAUTERYTIP_TO_CAUTERY)
-      cauteryTipToCautery.GetMatrixTransformToNode(needleToReference, cauteryTipToNeedle)
-      cauteryTip_needleTip = cauteryTipToNeedle.MultiplyFloatPoint([0, 0, 0, 1])
+      _, cauteryTipToNeedle, _ = self.transformCache.getMatrices()
+      cauteryTip_needleTip = cauteryTipToNeedle[:, 3]
 
       # Check if another fiducial already exists within threshold distance from cautery tip
-      breachMarkupsProximityThreshold = slicer.util.settingsValue(self.BREACH_MARKUPS_PROXIMITY_THRESHOLD, 1, converter=lambda x: int(x))
       breachMarkups_Needle = parameterNode.GetNodeReference(self.BREACH_MARKUPS_NEEDLE)
-      if not self.hasFiducialWithinDistance(breachMarkups_Needle, cauteryTip_needleTip[0:3], breachMarkupsProximityThreshold):
+      if not self.breachMarkupsIndex.hasPointWithinDistance(cauteryTip_needleTip, self.breachMarkupsProximityThreshold):
         breachMarkups_Needle.AddControlPoint(cauteryTip_needleTip[0], cauteryTip_needleTip[1], cauteryTip_needleTip[2], "")
         logging.info(f"Added breach warning fiducial at position {cauteryTip_needleTip[0:3]}")
 
     else:
-      # Remove corner annotation
-      for i in range(slicer.app.layoutManager().threeDViewCount):
-        view = slicer.app.layoutManager().threeDWidget(i).threeDView()
-        view.cornerAnnotation().SetText(vtk.vtkCornerAnnotation.LowerLeft, "")
-        view.forceRender()
       parameterNode.SetParameter(self.BREACH_STATUS, "False")
 
-  def hasFiducialWithinDistance(self, markupsNode, point, threshold):
-    numberOfPoints = markupsNode.GetNumberOfControlPoints()
-    for fiducialIndex in range(numberOfPoints):
-      fiducialPosition = markupsNode.GetNthControlPointPosition(fiducialIndex)
-      distance = self.calculateDistance(point, fiducialPosition)
-      if distance <= threshold:
-        return True
-    else:
-      return False
+  def setBreachMarkupsProximityThreshold(self, value):
+    self.breachMarkupsProximityThreshold = value
+    self.breachMarkupsIndex.setCellSize(value)
 
   def setBreachFiducialSize(self, value):
     parameterNode = self.getParameterNode()
@@ -3341,13 +5223,6 @@ class LumpNav2Logic(ScriptedLoadableModuleLogic, VTKObservationMixin):
     eventTableNode = parameterNode.GetNodeReference(self.EVENT_TABLE_NODE)
     eventTableNode.RemoveRow(row)
 
-  @staticmethod
-  def calculateDistance(point1, point2):
-    tumorFiducialPoint = np.array(point1)
-    eraserPoint = np.array(point2)
-    distance = np.linalg.norm(tumorFiducialPoint - eraserPoint)
-    return distance
-
   @staticmethod
   def createMatrixFromString(transformMatrixString):
     transformMatrix = vtk.vtkMatrix4x4()
@@ -3379,6 +5254,12 @@ class LumpNav2Test(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_LumpNav21()
+    self.test_TrackingDataBuffer()
+    self.test_TrackingDataJournal()
+    self.test_PointSpatialHash()
+    self.test_TumorSurfaceCache()
+    self.test_PointCoordinateMirror()
+    self.test_TumorDistanceMap()
 
   def test_LumpNav21(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -3415,3 +5296,307 @@ class LumpNav2Test(ScriptedLoadableModuleTest):
 
     self.delayDisplay('Test passed')
 
+  def test_TrackingDataBuffer(self):
+    """ Rows are kept when the buffer grows past its capacity, and the CSV export has the same text as the
+    original np.append based tracking log.
+    """
+    import io
+
+    self.delayDisplay("Starting the tracking data buffer test")
+
+    rng = np.random.default_rng(0)
+    trackingData = TrackingDataBuffer(capacity=3)
+    oldHeader = TrackingDataBuffer.CSV_HEADER[:10]
+    oldRows = []
+    numberOfRows = 10
+    for rowIndex in range(numberOfRows):
+      localTime = 1700000000.0 + rowIndex
+      currentTime = 12.5 + rowIndex * 0.04
+      tipNeedle = rng.normal(size=3) * 10
+      distance = float(rng.uniform(-5, 20))
+      speed = float(rng.uniform(0, 50))
+      center = rng.normal(size=3) * 10
+      extent = rng.uniform(10, 30, size=3)
+      scanNumber = rowIndex if rowIndex % 2 else None
+      trackingData.append(localTime=localTime, time=currentTime, scanNumber=scanNumber, tipNeedle=tipNeedle,
+                          distance=distance, speed=speed, tumorCenter=center, tumorExtent=extent,
+                          marginSizes=[2.0, 5.0], marginDistances=[distance - 2.0, distance - 5.0])
+
+      # Row as the original onTrackingDataModified added it to its string array
+      oldRows.append([time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(localTime)), str(currentTime), "",
+                      "" if scanNumber is None else str(scanNumber), np.array2string(tipNeedle), str(distance),
+                      str(speed), np.array2string(center), np.array2string(extent), ""])
+
+    self.assertEqual(len(trackingData), numberOfRows)
+    self.assertEqual(trackingData.column("time")[-1], 12.5 + (numberOfRows - 1) * 0.04)
+    self.assertTrue(np.isnan(trackingData.column("sendTime")).all())
+    self.assertEqual(trackingData.column("scanNumber")[0], TrackingDataBuffer.MISSING_INT)
+    self.assertTrue(np.isnan(trackingData.column("marginSizes")[:, 2:]).all())
+
+    def readCsv(df):
+      csvText = df.to_csv(index=False)
+      return pd.read_csv(io.StringIO(csvText), dtype=str, keep_default_na=False)
+
+    expected = readCsv(pd.DataFrame(oldRows, columns=oldHeader))
+    actual = readCsv(trackingData.toDataFrame())
+    self.assertEqual(list(actual.columns), TrackingDataBuffer.CSV_HEADER)
+    pd.testing.assert_frame_equal(actual[oldHeader], expected)
+    self.assertEqual(actual["Margin Sizes (mm)"][0], np.array2string(np.array([2.0, 5.0])))
+
+    self.delayDisplay('Test passed')
+
+  def test_TrackingDataJournal(self):
+    """ Journal rows are read back and recovered, also from a journal that was not closed and whose last chunk is
+    truncated or corrupted, and after a write error.
+    """
+    import tempfile
+
+    self.delayDisplay("Starting the tracking data journal test")
+
+    def makeRow(rowIndex):
+      return dict(localTime=1700000000.0 + rowIndex, time=0.04 * rowIndex, scanNumber=rowIndex,
+                  tipNeedle=[rowIndex, -rowIndex, 0.5], distance=rowIndex - 10.0, speed=None,
+                  marginSizes=[2.0, 5.0], marginDistances=[rowIndex - 12.0, rowIndex - 15.0])
+
+    def writeJournal(journalPath, chunkSizes):
+      journal = TrackingDataJournal(journalPath)
+      trackingData = TrackingDataBuffer()
+      rowIndex = 0
+      for chunkSize in chunkSizes:
+        for _ in range(chunkSize):
+          row = makeRow(rowIndex)
+          journal.append(row)
+          trackingData.append(**row)
+          rowIndex += 1
+        journal.flush(wait=True)  # each flush writes its rows as separate chunks
+      return journal, trackingData
+
+    def assertSameRows(actual, expected, numberOfRows):
+      self.assertEqual(len(actual), numberOfRows)
+      for name in TrackingDataBuffer.COLUMNS:
+        np.testing.assert_array_equal(actual.column(name), expected.column(name)[:numberOfRows])
+
+    with tempfile.TemporaryDirectory() as tempDir:
+      # Closed journal, with footer
+      journalPath = os.path.join(tempDir, "Closed.lntj")
+      journal, trackingData = writeJournal(journalPath, [5, 7, 3])
+      journal.close()
+      assertSameRows(TrackingDataJournal.read(journalPath), trackingData, 15)
+      csvPath = os.path.join(tempDir, "Recovered.csv")
+      recovered = LumpNav2Logic.recoverTrackingJournal(journalPath, csvPath)
+      pd.testing.assert_frame_equal(recovered, trackingData.toDataFrame())
+      self.assertTrue(os.path.exists(csvPath))
+
+      # Journal that was not closed, e.g. after a crash
+      journalPath = os.path.join(tempDir, "Crashed.lntj")
+      journal, trackingData = writeJournal(journalPath, [5, 7, 3])
+      with open(journalPath, "rb") as journalFile:
+        data = journalFile.read()
+      lastChunkOffset = journal._chunkOffsets[-1]
+      journal.close()
+      with open(journalPath, "wb") as journalFile:
+        journalFile.write(data)
+      assertSameRows(TrackingDataJournal.read(journalPath), trackingData, 15)
+
+      # Last chunk truncated
+      with open(journalPath, "wb") as journalFile:
+        journalFile.write(data[:-10])
+      assertSameRows(TrackingDataJournal.read(journalPath), trackingData, 12)
+
+      # Last chunk corrupted
+      corrupted = bytearray(data)
+      corrupted[lastChunkOffset + TrackingDataJournal._CHUNK_HEADER.size + 1] ^= 0xFF
+      with open(journalPath, "wb") as journalFile:
+        journalFile.write(bytes(corrupted))
+      assertSameRows(TrackingDataJournal.read(journalPath), trackingData, 12)
+
+      # Write error: rows written before the error are kept, and the error is reported on the main thread
+      journalPath = os.path.join(tempDir, "WriteError.lntj")
+      journal, trackingData = writeJournal(journalPath, [4])
+      journal._file.close()
+      journal.append(makeRow(4))
+      with self.assertRaises(OSError):
+        journal.flush(wait=True)
+      with self.assertRaises(OSError):
+        journal.append(makeRow(5))
+      journal.close()
+      assertSameRows(TrackingDataJournal.read(journalPath), trackingData, 4)
+
+    self.delayDisplay('Test passed')
+
+  def test_PointSpatialHash(self):
+    """ Proximity queries of the breach markups spatial hash agree with brute force after points are added, moved
+    and removed, and after the cell size changes.
+    """
+    self.delayDisplay("Starting the point spatial hash test")
+
+    rng = np.random.default_rng(0)
+    markupsNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode")
+    spatialHash = PointSpatialHash(cellSize=1.0)
+    spatialHash.setMarkupsNode(markupsNode)
+    queryPoints = rng.uniform(-12, 12, size=(300, 3))
+
+    def assertMatchesBruteForce(distance):
+      positions = slicer.util.arrayFromMarkupsControlPoints(markupsNode).reshape(-1, 3)
+      self.assertEqual(len(spatialHash), len(positions))
+      for queryPoint in queryPoints:
+        expected = bool(len(positions)) and np.linalg.norm(positions - queryPoint, axis=1).min() <= distance
+        self.assertEqual(spatialHash.hasPointWithinDistance(queryPoint, distance), expected)
+
+    for position in rng.uniform(-10, 10, size=(50, 3)):
+      markupsNode.AddControlPoint(*position)
+    assertMatchesBruteForce(1.0)
+    assertMatchesBruteForce(2.5)  # larger than the cell size
+
+    for pointIndex in (0, 17, 49):
+      markupsNode.SetNthControlPointPosition(pointIndex, *rng.uniform(-10, 10, size=3))
+    assertMatchesBruteForce(1.0)
+
+    for pointIndex in (30, 5, 0):
+      markupsNode.RemoveNthControlPoint(pointIndex)
+    assertMatchesBruteForce(1.0)
+
+    spatialHash.setCellSize(3.0)
+    assertMatchesBruteForce(1.0)
+    assertMatchesBruteForce(3.0)
+
+    markupsNode.RemoveAllControlPoints()
+    assertMatchesBruteForce(1.0)
+
+    spatialHash.setMarkupsNode(None)
+    slicer.mrmlScene.RemoveNode(markupsNode)
+    self.delayDisplay('Test passed')
+
+  def test_TumorSurfaceCache(self):
+    """ Tumor surface cache keys do not depend on point order or repeated points, and the least recently used
+    surfaces are evicted by entry count and by memory size.
+    """
+    self.delayDisplay("Starting the tumor surface cache test")
+
+    rng = np.random.default_rng(0)
+
+    def makeSurface(radius):
+      sphereSource = vtk.vtkSphereSource()
+      sphereSource.SetRadius(radius)
+      sphereSource.Update()
+      return sphereSource.GetOutput()
+
+    # Points on the quantization grid, so a small offset does not round to another grid point
+    pointSets = [np.round(rng.uniform(-10, 10, size=(8, 3)) / TumorSurfaceCache.QUANTIZATION_MM)
+                 * TumorSurfaceCache.QUANTIZATION_MM for _ in range(4)]
+    surfaces = [makeSurface(radius) for radius in range(1, 5)]
+
+    cache = TumorSurfaceCache(maximumEntries=3)
+    self.assertIsNone(cache.get(pointSets[0]))
+    for points, surface in zip(pointSets[:3], surfaces[:3]):
+      cache.put(points, surface)
+    self.assertEqual(len(cache), 3)
+
+    # Same point set in another order, with a repeated point and below the quantization
+    points = np.vstack((pointSets[0][::-1], pointSets[0][:1])) + TumorSurfaceCache.QUANTIZATION_MM * 0.1
+    self.assertIs(cache.get(points), surfaces[0])
+
+    # Point set 1 is now the least recently used
+    cache.put(pointSets[3], surfaces[3])
+    self.assertEqual(len(cache), 3)
+    self.assertIsNone(cache.get(pointSets[1]))
+    for pointSetIndex in (0, 2, 3):
+      self.assertIs(cache.get(pointSets[pointSetIndex]), surfaces[pointSetIndex])
+    self.assertEqual(cache.hits, 4)
+    self.assertEqual(cache.misses, 2)
+
+    # Memory limit that only fits the most recent surface
+    memoryKiB = max(surface.GetActualMemorySize() for surface in surfaces)
+    cache = TumorSurfaceCache(maximumEntries=10, maximumMemoryMb=1.5 * memoryKiB / 1024)
+    for points, surface in zip(pointSets, surfaces):
+      cache.put(points, surface)
+    self.assertEqual(len(cache), 1)
+    self.assertIs(cache.get(pointSets[3]), surfaces[3])
+
+    cache.clear()
+    self.assertEqual(len(cache), 0)
+    self.assertIsNone(cache.get(pointSets[3]))
+    self.delayDisplay('Test passed')
+
+  def test_PointCoordinateMirror(self):
+    """ Positions and KD-tree queries of the tumor markups mirror agree with the markups node and brute force after
+    points are added, inserted, moved and removed.
+    """
+    self.delayDisplay("Starting the point coordinate mirror test")
+
+    rng = np.random.default_rng(0)
+    markupsNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode")
+    mirror = PointCoordinateMirror()
+    mirror.setMarkupsNode(markupsNode)
+    queryPoints = rng.uniform(-12, 12, size=(100, 3))
+
+    def assertMatchesBruteForce():
+      positions = slicer.util.arrayFromMarkupsControlPoints(markupsNode).reshape(-1, 3)
+      np.testing.assert_allclose(mirror.positions, positions)
+      for count in (len(positions), len(positions) - 1):
+        for queryPoint in queryPoints:
+          distances = np.linalg.norm(positions[:count] - queryPoint, axis=1)
+          index, distance = mirror.findClosestPoint(queryPoint, count)
+          if count <= 0:
+            self.assertIsNone(index)
+            self.assertEqual(distance, np.inf)
+            self.assertEqual(mirror.findPointsWithinRadius(queryPoint, 3.0, count), [])
+            continue
+          self.assertAlmostEqual(distance, distances.min())
+          self.assertAlmostEqual(distances[index], distances.min())
+          self.assertEqual(mirror.findPointsWithinRadius(queryPoint, 3.0, count),
+                           np.flatnonzero(distances <= 3.0).tolist())
+
+    for position in rng.uniform(-10, 10, size=(40, 3)):
+      markupsNode.AddControlPoint(*position)
+    assertMatchesBruteForce()
+
+    markupsNode.InsertControlPoint(5, vtk.vtkVector3d(*rng.uniform(-10, 10, size=3)), "")
+    assertMatchesBruteForce()
+
+    for pointIndex in (0, 17, 40):
+      markupsNode.SetNthControlPointPosition(pointIndex, *rng.uniform(-10, 10, size=3))
+    assertMatchesBruteForce()
+
+    for pointIndex in (30, 5, 0):
+      markupsNode.RemoveNthControlPoint(pointIndex)
+    assertMatchesBruteForce()
+
+    markupsNode.RemoveAllControlPoints()
+    assertMatchesBruteForce()
+
+    mirror.setMarkupsNode(None)
+    slicer.mrmlScene.RemoveNode(markupsNode)
+    self.delayDisplay('Test passed')
+
+  def test_TumorDistanceMap(self):
+    """ Margin shells of a sphere extracted from its distance map are within one voxel spacing of the exact
+    dilated sphere.
+    """
+    self.delayDisplay("Starting the tumor distance map test")
+
+    radius = 10.0
+    center = np.array([3.0, -2.0, 5.0])
+    sphereSource = vtk.vtkSphereSource()
+    sphereSource.SetRadius(radius)
+    sphereSource.SetCenter(*center)
+    sphereSource.SetThetaResolution(64)
+    sphereSource.SetPhiResolution(64)
+    sphereSource.Update()
+
+    margins = [-2.0, 2.0, 5.0]
+    distanceMap = TumorDistanceMap(sphereSource.GetOutput(), max(margins))
+    self.assertEqual(distanceMap.spacing, TumorDistanceMap.SPACING_DEFAULT)
+    for margin, surface in zip(margins, distanceMap.extractSurfaces(margins)):
+      self.assertGreater(surface.GetNumberOfPoints(), 0)
+      points = numpy_support.vtk_to_numpy(surface.GetPoints().GetData())
+      errors = np.abs(np.linalg.norm(points - center, axis=1) - (radius + margin))
+      self.assertLessEqual(errors.max(), distanceMap.spacing)
+
+    with self.assertRaises(ValueError):
+      distanceMap.extractSurface(max(margins) + 1.0)
+    with self.assertRaises(ValueError):
+      TumorDistanceMap(vtk.vtkPolyData(), 5.0)
+
+    self.delayDisplay('Test passed')
+
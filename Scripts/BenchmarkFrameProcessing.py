@@ -0,0 +1,111 @@
+"""
+Compares the per-frame time and memory allocations of the RealtimeInference preprocessing and postprocessing paths:
+legacy (preprocess_input, softmax, postprocess_prediction) and the preallocated FrameProcessor buffers.
+The model is not run: random logits of the model output shape stand in for the prediction.
+Usage:
+    python BenchmarkFrameProcessing.py --height 615 --width 525 --input-size 128 --frames 500
+Arguments:
+    height, width: size of the ultrasound image
+    input size: model input size (config.json shape)
+    classes: number of model output channels
+    frames: number of frames timed for each path
+"""
+
+import argparse
+import logging
+import sys
+import time
+import tracemalloc
+import traceback
+
+import numpy as np
+import torch
+
+import RealtimeInference
+
+
+# Parse command line arguments
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--height", type=int, default=615)
+    parser.add_argument("--width", type=int, default=525)
+    parser.add_argument("--input-size", type=int, default=128)
+    parser.add_argument("--classes", type=int, default=2)
+    parser.add_argument("--frames", type=int, default=500)
+    try:
+        return parser.parse_args()
+    except SystemExit as err:
+        traceback.print_exc()
+        sys.exit(err.code)
+
+
+def legacy_frame(image, logits, input_size):
+    model_input = RealtimeInference.preprocess_input(image, input_size)
+    prediction = torch.nn.functional.softmax(logits, dim=1)
+    return model_input, RealtimeInference.postprocess_prediction(prediction, image.shape)
+
+
+def fast_frame(processor, image, logits):
+    model_input = processor.preprocess(image)
+    output = processor.postprocess(logits, image.shape)
+    processor.release_message(argparse.Namespace(image=output))  # as the send stage does after sending
+    return model_input, output
+
+
+# Returns the torch CPU bytes allocated per frame (torch profiler) and the peak numpy bytes of one frame (tracemalloc)
+def measure_allocations(run_frame, frames):
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as profiler:
+        for _ in range(frames):
+            run_frame()
+    torch_bytes = sum(max(event.self_cpu_memory_usage, 0) for event in profiler.key_averages())
+
+    peaks = []
+    tracemalloc.start()
+    for _ in range(frames):
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        run_frame()
+        peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    tracemalloc.stop()
+    return torch_bytes / frames, float(np.median(peaks))
+
+
+def measure_times(run_frame, frames):
+    times = []
+    for _ in range(frames):
+        start_time = time.perf_counter()
+        run_frame()
+        times.append((time.perf_counter() - start_time) * 1000.0)
+    return float(np.median(times)), float(np.percentile(times, 95))
+
+
+def main():
+    args = parse_args()
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, size=(1, args.height, args.width), dtype=np.uint8)
+    logits = torch.from_numpy(rng.normal(scale=4.0, size=(1, args.classes, args.input_size, args.input_size))
+                              .astype(np.float32))
+    processor = RealtimeInference.FrameProcessor(args.input_size, torch.device("cpu"))
+
+    paths = {
+        "legacy": lambda: legacy_frame(image, logits, args.input_size),
+        "preallocated": lambda: fast_frame(processor, image, logits),
+    }
+    for name, run_frame in paths.items():
+        for _ in range(10):  # warm up
+            run_frame()
+        median_ms, p95_ms = measure_times(run_frame, args.frames)
+        torch_bytes, numpy_bytes = measure_allocations(run_frame, min(args.frames, 100))
+        logging.info(f"{name}: {median_ms:.3f} ms median, {p95_ms:.3f} ms 95th percentile, "
+                     f"{torch_bytes / 1024:.1f} KiB torch and {numpy_bytes / 1024:.1f} KiB numpy allocated per frame")
+
+    legacy_input, legacy_output = paths["legacy"]()
+    fast_input, fast_output = paths["preallocated"]()
+    input_difference = float((legacy_input - fast_input).abs().max())
+    output_difference = int(np.abs(legacy_output.astype(np.int16) - fast_output.astype(np.int16)).max())
+    logging.info(f"Largest difference: {input_difference:.2e} in the model input, {output_difference} in the output")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    main()
@@ -0,0 +1,493 @@
+"""
+Times the stages of the LumpNav2 tumor geometry pipelines on synthetic data and writes the results to a JSON file.
+Covered pipelines: tumor from markups (createTumorFromMarkups), hydromark ellipsoid (createTumorFromHydromark),
+AI tumor convex hull (createConvexHullFromVolume) and tumor margin dilation (applyDilation).
+Run with 3D Slicer in batch mode, with the LumpNav2 module on the module path:
+    Slicer --no-main-window --python-script BenchmarkGeometryPipelines.py --output D:/Benchmarks/LumpNav2-main.json
+Arguments:
+    output: JSON file of the results
+    repeats: number of times each stage is timed
+    point counts: tumor markups point counts. Each count is benchmarked with a point cloud and with ellipsoid points
+    labelmap sizes: number of voxels along each axis of the synthetic tumor volumes. Field of view is always 100 mm
+    margin: dilation margin in mm
+    shell margins: margins in mm of the multiple shell dilation
+    baseline: JSON file of an earlier run. Median times of matching stages are compared to it
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+import traceback
+
+import numpy as np
+import slicer
+import vtk
+
+TUMOR_RADII_MM = (15.0, 10.0, 12.0)
+FIELD_OF_VIEW_MM = 100.0
+
+
+# Parse command line arguments
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", type=str, default="LumpNav2GeometryBenchmark.json")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--point-counts", type=int, nargs="+", default=[10, 50, 200, 1000])
+    parser.add_argument("--labelmap-sizes", type=int, nargs="+", default=[64, 128, 256])
+    parser.add_argument("--margin", type=float, default=5.0)
+    parser.add_argument("--shell-margins", type=float, nargs="+", default=[2.0, 5.0, 10.0])
+    parser.add_argument("--baseline", type=str, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    try:
+        return parser.parse_args(sys.argv[1:])
+    except SystemExit as err:
+        traceback.print_exc()
+        slicer.util.exit(err.code)
+
+
+@contextlib.contextmanager
+def timed(timings, stage):
+    start_time = time.perf_counter()
+    yield
+    timings.setdefault(stage, []).append((time.perf_counter() - start_time) * 1000.0)
+
+
+def summarize(timings):
+    return {stage: {"repeats": len(times),
+                    "min_ms": float(np.min(times)),
+                    "median_ms": float(np.median(times)),
+                    "mean_ms": float(np.mean(times)),
+                    "max_ms": float(np.max(times))}
+            for stage, times in timings.items()}
+
+
+def get_environment():
+    try:
+        revision = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                  capture_output=True, text=True).stdout.strip()
+    except OSError:
+        revision = ""
+    return {"slicer_version": slicer.app.applicationVersion,
+            "slicer_revision": slicer.app.revision,
+            "vtk_version": vtk.vtkVersion.GetVTKVersion(),
+            "numpy_version": np.__version__,
+            "python_version": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "lumpnav_revision": revision,
+            "date": datetime.datetime.now().isoformat(timespec="seconds")}
+
+
+# Tumor markups point sets. Cloud points are mostly inside the hull, ellipsoid points are all on it.
+def make_point_cloud(count, rng):
+    return rng.normal(scale=np.array(TUMOR_RADII_MM) / 2.0, size=(count, 3))
+
+
+def make_ellipsoid_points(count, rng):
+    directions = rng.normal(size=(count, 3))
+    directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+    return directions * TUMOR_RADII_MM
+
+
+# Binary ellipsoid of TUMOR_RADII_MM in a size^3 volume centered on the origin
+def make_ellipsoid_volume(size, node_class_name, name):
+    spacing = FIELD_OF_VIEW_MM / size
+    coordinates = (np.arange(size) - (size - 1) / 2.0) * spacing
+    k, j, i = np.meshgrid(coordinates, coordinates, coordinates, indexing="ij")
+    inside = ((i / TUMOR_RADII_MM[0]) ** 2 + (j / TUMOR_RADII_MM[1]) ** 2 + (k / TUMOR_RADII_MM[2]) ** 2) <= 1.0
+    ijk_to_ras = np.diag([spacing, spacing, spacing, 1.0])
+    ijk_to_ras[:3, 3] = -(size - 1) / 2.0 * spacing
+    voxels = inside.astype(np.uint8 if node_class_name == "vtkMRMLLabelMapVolumeNode" else np.float32)
+    return slicer.util.addVolumeFromArray(voxels, ijk_to_ras, name, node_class_name)
+
+
+def points_to_poly_data(points):
+    vtk_points = vtk.vtkPoints()
+    cell_array = vtk.vtkCellArray()
+    vtk_points.SetNumberOfPoints(len(points))
+    cell_array.InsertNextCell(len(points))
+    for i, point in enumerate(points):
+        vtk_points.SetPoint(i, point)
+        cell_array.InsertCellPoint(i)
+    poly_data = vtk.vtkPolyData()
+    poly_data.SetLines(cell_array)
+    poly_data.SetPoints(vtk_points)
+    return poly_data
+
+
+# Smoothed tumor surface pipeline of IncrementalTumorHull.getSurface, timed stage by stage: cube glyphs, vtkDelaunay3D,
+# butterfly subdivision, a second vtkDelaunay3D and normals. createTumorFromMarkups runs it when the hull changed
+def benchmark_markups_delaunay(points, repeats):
+    timings = {}
+    for _ in range(repeats):
+        with timed(timings, "point_conversion"):
+            point_poly_data = points_to_poly_data(points)
+        with timed(timings, "glyph"):
+            glyph = vtk.vtkGlyph3D()
+            glyph.SetInputData(point_poly_data)
+            cube = vtk.vtkCubeSource()
+            glyph.SetSourceConnection(cube.GetOutputPort())
+            glyph.Update()
+        with timed(timings, "delaunay"):
+            delaunay = vtk.vtkDelaunay3D()
+            delaunay.SetInputData(glyph.GetOutput())
+            surface_filter = vtk.vtkDataSetSurfaceFilter()
+            surface_filter.SetInputConnection(delaunay.GetOutputPort())
+            surface_filter.Update()
+        with timed(timings, "subdivision"):
+            smoother = vtk.vtkButterflySubdivisionFilter()
+            smoother.SetInputData(surface_filter.GetOutput())
+            smoother.SetNumberOfSubdivisions(3)
+            smoother.Update()
+        with timed(timings, "smooth_delaunay"):
+            delaunay_smooth = vtk.vtkDelaunay3D()
+            delaunay_smooth.SetInputData(smoother.GetOutput())
+            smooth_surface_filter = vtk.vtkDataSetSurfaceFilter()
+            smooth_surface_filter.SetInputConnection(delaunay_smooth.GetOutputPort())
+            smooth_surface_filter.Update()
+        with timed(timings, "normals"):
+            normals = vtk.vtkPolyDataNormals()
+            normals.SetInputData(smooth_surface_filter.GetOutput())
+            normals.SetFeatureAngle(100)
+            normals.Update()
+    return timings
+
+
+# Current createTumorFromMarkups surface: incremental convex hull preview, then the smoothed surface
+def benchmark_markups_hull(points, repeats):
+    import LumpNav2
+
+    timings = {}
+    for _ in range(repeats):
+        hull = LumpNav2.IncrementalTumorHull()
+        with timed(timings, "hull"):
+            hull.update(points)
+        with timed(timings, "hull_poly_data"):
+            hull.getHullPolyData()
+        with timed(timings, "smooth_surface"):
+            hull.getSurface()
+
+        # Longest time TumorSurfaceWorker blocks the main thread, i.e. tracking and breach warning callbacks
+        hull = LumpNav2.IncrementalTumorHull()
+        hull.update(points)
+        step_times = []
+        steps = hull.computeSurfaceSteps()
+        while True:
+            start_time = time.perf_counter()
+            try:
+                next(steps)
+            except StopIteration:
+                break
+            finally:
+                step_times.append((time.perf_counter() - start_time) * 1000.0)
+        timings.setdefault("longest_surface_step", []).append(max(step_times))
+
+        # Cost of placing one more point on an existing tumor
+        hull = LumpNav2.IncrementalTumorHull()
+        hull.update(points[:-1])
+        with timed(timings, "hull_append_point"):
+            hull.update(points)
+    return timings
+
+
+def make_hydromark_ellipsoid():
+    ellipsoid = vtk.vtkParametricEllipsoid()
+    ellipsoid.SetXRadius(TUMOR_RADII_MM[0])
+    ellipsoid.SetYRadius(TUMOR_RADII_MM[1])
+    ellipsoid.SetZRadius(TUMOR_RADII_MM[2])
+    func_source = vtk.vtkParametricFunctionSource()
+    func_source.SetParametricFunction(ellipsoid)
+    func_source.SetUResolution(24)
+    func_source.SetVResolution(24)
+    func_source.SetWResolution(24)
+    func_source.Update()
+    return func_source.GetOutput()
+
+
+def rotate_hydromark(poly_data):
+    transform = vtk.vtkTransform()
+    transform.RotateZ(30)
+    transform_filter = vtk.vtkTransformPolyDataFilter()
+    transform_filter.SetInputData(poly_data)
+    transform_filter.SetTransform(transform)
+    transform_filter.Update()
+    return transform_filter.GetOutput()
+
+
+# Tumor surface made by createTumorFromHydromark
+def make_hydromark_surface():
+    return rotate_hydromark(make_hydromark_ellipsoid())
+
+
+def benchmark_hydromark(repeats):
+    timings = {}
+    for _ in range(repeats):
+        with timed(timings, "ellipsoid_source"):
+            ellipsoid = make_hydromark_ellipsoid()
+        with timed(timings, "transform"):
+            rotate_hydromark(ellipsoid)
+    return timings
+
+
+# Same stages as createConvexHullFromVolume
+def benchmark_convex_hull_from_volume(size, repeats):
+    import LumpNav2
+
+    timings = {}
+    volume_node = make_ellipsoid_volume(size, "vtkMRMLScalarVolumeNode", "BenchmarkReconstruction")
+    try:
+        for _ in range(repeats):
+            model_node = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode")
+            parameters = {
+                "InputVolume": volume_node.GetID(),
+                "OutputGeometry": model_node.GetID(),
+                "Threshold": 0.5,
+                "Smooth": LumpNav2.LumpNav2Logic.DEFAULT_SMOOTH,
+                "Decimate": LumpNav2.LumpNav2Logic.DEFAULT_DECIMATE,
+                "SplitNormals": True,
+                "PointNormals": True
+            }
+            with timed(timings, "grayscale_model_maker"):
+                cli_node = slicer.cli.runSync(slicer.modules.grayscalemodelmaker, None, parameters)
+            failed = cli_node.GetStatus() & cli_node.ErrorsMask
+            error_text = cli_node.GetErrorText()
+            slicer.mrmlScene.RemoveNode(cli_node)
+            if failed:
+                slicer.mrmlScene.RemoveNode(model_node)
+                raise ValueError("CLI execution failed: " + error_text)
+            with timed(timings, "largest_region"):
+                connectivity_filter = vtk.vtkPolyDataConnectivityFilter()
+                connectivity_filter.SetInputData(model_node.GetPolyData())
+                connectivity_filter.SetExtractionModeToLargestRegion()
+                clean_filter = vtk.vtkCleanPolyData()
+                clean_filter.SetInputConnection(connectivity_filter.GetOutputPort())
+                clean_filter.Update()
+            with timed(timings, "delaunay"):
+                convex_hull = vtk.vtkDelaunay3D()
+                convex_hull.SetInputData(clean_filter.GetOutput())
+                outer_surface = vtk.vtkGeometryFilter()
+                outer_surface.SetInputConnection(convex_hull.GetOutputPort())
+                outer_surface.Update()
+            slicer.mrmlScene.RemoveNode(model_node)
+    finally:
+        slicer.mrmlScene.RemoveNode(volume_node)
+    return timings
+
+
+def create_segment_editor_widget():
+    segment_editor_widget = slicer.qMRMLSegmentEditorWidget()
+    segment_editor_widget.setMRMLScene(slicer.mrmlScene)
+    segment_editor_node = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentEditorNode")
+    segment_editor_widget.setMRMLSegmentEditorNode(segment_editor_node)
+    return segment_editor_widget, segment_editor_node
+
+
+# Margin effect and model export, as in applyDilation
+def apply_margin_and_export(segmentation_node, margin, timings):
+    segmentation_logic = slicer.modules.segmentations.logic()
+    segment_id = segmentation_node.GetSegmentation().GetNthSegmentID(0)
+    with timed(timings, "segment_editor_setup"):
+        segment_editor_widget, segment_editor_node = create_segment_editor_widget()
+        segment_editor_widget.setSegmentationNode(segmentation_node)
+        segment_editor_widget.setCurrentSegmentID(segment_id)
+    with timed(timings, "margin_effect"):
+        segment_editor_widget.setActiveEffectByName("Margin")
+        effect = segment_editor_widget.activeEffect()
+        effect.setParameter("MarginSizeMm", margin)
+        effect.setParameter("SelectedSegmentID", segment_id)
+        effect.self().onApply()
+    sh_node = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
+    folder_item = sh_node.CreateFolderItem(sh_node.GetSceneItemID(), sh_node.GenerateUniqueItemName("Benchmark"))
+    with timed(timings, "export"):
+        segmentation_logic.ExportSegmentsToModels(segmentation_node, [segment_id], folder_item)
+    sh_node.RemoveItem(folder_item)
+    segment_editor_widget.setActiveEffect(None)
+    segment_editor_widget.setSegmentationNode(None)
+    slicer.mrmlScene.RemoveNode(segment_editor_node)
+
+
+# Margin dilation of a labelmap of size^3 voxels
+def benchmark_dilation_labelmap(size, margin, repeats):
+    segmentation_logic = slicer.modules.segmentations.logic()
+    timings = {}
+    labelmap_node = make_ellipsoid_volume(size, "vtkMRMLLabelMapVolumeNode", "BenchmarkTumorLabelmap")
+    try:
+        for _ in range(repeats):
+            segmentation_node = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
+            with timed(timings, "segmentation_import"):
+                segmentation_logic.ImportLabelmapToSegmentationNode(labelmap_node, segmentation_node)
+            apply_margin_and_export(segmentation_node, margin, timings)
+            slicer.mrmlScene.RemoveNode(segmentation_node)
+    finally:
+        slicer.mrmlScene.RemoveNode(labelmap_node)
+    return timings
+
+
+# Segment editor applyDilation on a tumor model, including the model import and the 20 cm ROI resampling
+def benchmark_dilation_model(points, margin, repeats):
+    import LumpNav2
+
+    segmentation_logic = slicer.modules.segmentations.logic()
+    timings = {}
+    hull = LumpNav2.IncrementalTumorHull()
+    hull.update(points)
+    model_node = slicer.modules.models.logic().AddModel(hull.getSurface())
+    roi_node = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsROINode")
+    roi_node.SetDisplayVisibility(False)
+    roi_node.SetXYZ(np.mean(points, axis=0))
+    roi_node.SetRadiusXYZ(100, 100, 100)
+    try:
+        for _ in range(repeats):
+            segmentation_node = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
+            with timed(timings, "segmentation_import"):
+                segmentation_logic.ImportModelToSegmentationNode(model_node, segmentation_node)
+            with timed(timings, "roi_resample"):
+                geometry_logic = slicer.vtkSlicerSegmentationGeometryLogic()
+                geometry_logic.SetInputSegmentationNode(segmentation_node)
+                geometry_logic.SetSourceGeometryNode(roi_node)
+                geometry_logic.CalculateOutputGeometry()
+                segment_id = segmentation_node.GetSegmentation().GetNthSegmentID(0)
+                labelmap = segmentation_node.GetBinaryLabelmapInternalRepresentation(segment_id)
+                slicer.vtkOrientedImageDataResample.ResampleOrientedImageToReferenceOrientedImage(
+                    labelmap, geometry_logic.GetOutputGeometryImageData(), labelmap)
+            apply_margin_and_export(segmentation_node, margin, timings)
+            slicer.mrmlScene.RemoveNode(segmentation_node)
+    finally:
+        slicer.mrmlScene.RemoveNode(roi_node)
+        slicer.mrmlScene.RemoveNode(model_node)
+    return timings
+
+
+# applyDilation of non-convex models: distance map of the model and its iso-surface at the margin
+def benchmark_dilation_distance_map(points, margin, repeats):
+    import LumpNav2
+
+    timings = {}
+    hull = LumpNav2.IncrementalTumorHull()
+    hull.update(points)
+    surface = hull.getSurface()
+    for _ in range(repeats):
+        with timed(timings, "distance_map"):
+            distance_map = LumpNav2.TumorDistanceMap(surface, margin)
+        with timed(timings, "surface_extraction"):
+            distance_map.extractSurface(margin)
+    return timings
+
+
+# applyDilation of convex models: exact offset of the convex hull. Measured on the hydromark ellipsoid, because the
+# smoothed tumor from markups is usually not convex within ConvexHullOffset.CONVEXITY_TOLERANCE and is dilated with
+# the distance map instead
+def benchmark_dilation_convex_offset(margin, repeats):
+    import LumpNav2
+
+    timings = {}
+    surface = make_hydromark_surface()
+    if not LumpNav2.ConvexHullOffset(surface).isConvex:
+        raise ValueError("Hydromark surface is not convex")
+    for _ in range(repeats):
+        with timed(timings, "convexity_check"):
+            convex_offset = LumpNav2.ConvexHullOffset(surface)
+        with timed(timings, "offset_surface"):
+            convex_offset.offsetSurface(margin)
+    return timings
+
+
+# Non-convex models: one distance map for all margin shells
+def benchmark_dilation_shells(points, margins, repeats):
+    import LumpNav2
+
+    timings = {}
+    hull = LumpNav2.IncrementalTumorHull()
+    hull.update(points)
+    surface = hull.getSurface()
+    for _ in range(repeats):
+        with timed(timings, "distance_map"):
+            distance_map = LumpNav2.TumorDistanceMap(surface, max(margins))
+        with timed(timings, "surface_extraction"):
+            distance_map.extractSurfaces(margins)
+    return timings
+
+
+def run_benchmarks(args):
+    rng = np.random.default_rng(args.seed)
+    results = []
+
+    def add_result(pipeline, inputs, benchmark, *benchmark_args):
+        start_time = time.time()
+        try:
+            stages = summarize(benchmark(*benchmark_args))
+        except Exception:
+            logging.error(f"{pipeline} {inputs} failed:\n{traceback.format_exc()}")
+            stages = {}
+        logging.info(f"{pipeline} {inputs} finished in {time.time() - start_time:.1f} s")
+        results.append({"pipeline": pipeline, "input": inputs, "stages": stages})
+
+    for count in args.point_counts:
+        for shape, make_points in (("cloud", make_point_cloud), ("ellipsoid", make_ellipsoid_points)):
+            points = make_points(count, rng)
+            inputs = {"shape": shape, "points": count}
+            add_result("markups_delaunay", inputs, benchmark_markups_delaunay, points, args.repeats)
+            add_result("markups_hull", inputs, benchmark_markups_hull, points, args.repeats)
+
+    add_result("hydromark", {"shape": "ellipsoid"}, benchmark_hydromark, args.repeats)
+
+    for size in args.labelmap_sizes:
+        inputs = {"shape": "ellipsoid", "size": size, "spacing_mm": FIELD_OF_VIEW_MM / size}
+        add_result("convex_hull_from_volume", inputs, benchmark_convex_hull_from_volume, size, args.repeats)
+        add_result("dilation_labelmap", dict(inputs, margin_mm=args.margin),
+                   benchmark_dilation_labelmap, size, args.margin, args.repeats)
+
+    points = make_ellipsoid_points(max(args.point_counts), rng)
+    add_result("dilation_model", {"shape": "ellipsoid", "points": len(points), "margin_mm": args.margin},
+               benchmark_dilation_model, points, args.margin, args.repeats)
+    add_result("dilation_distance_map", {"shape": "ellipsoid", "points": len(points), "margin_mm": args.margin},
+               benchmark_dilation_distance_map, points, args.margin, args.repeats)
+    add_result("dilation_convex_offset", {"shape": "hydromark", "margin_mm": args.margin},
+               benchmark_dilation_convex_offset, args.margin, args.repeats)
+    add_result("dilation_shells", {"shape": "ellipsoid", "points": len(points), "margins_mm": args.shell_margins},
+               benchmark_dilation_shells, points, args.shell_margins, args.repeats)
+    return results
+
+
+# Logs the median time ratio of the stages that are also in the baseline results
+def compare_to_baseline(results, baseline_path):
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    baseline_stages = {}
+    for result in baseline["results"]:
+        key = (result["pipeline"], json.dumps(result["input"], sort_keys=True))
+        baseline_stages[key] = result["stages"]
+    for result in results:
+        stages = baseline_stages.get((result["pipeline"], json.dumps(result["input"], sort_keys=True)), {})
+        for stage, statistics in result["stages"].items():
+            if stage not in stages:
+                continue
+            ratio = statistics["median_ms"] / max(stages[stage]["median_ms"], 1e-6)
+            logging.info(f"{result['pipeline']} {result['input']} {stage}: {statistics['median_ms']:.2f} ms "
+                         f"(baseline {stages[stage]['median_ms']:.2f} ms, x{ratio:.2f})")
+
+
+def main():
+    args = parse_args()
+    results = run_benchmarks(args)
+    output = {"environment": get_environment(), "parameters": vars(args), "results": results}
+    output_dir = os.path.dirname(os.path.abspath(args.output))
+    os.makedirs(output_dir, exist_ok=True)
+    with open(args.output, "w") as output_file:
+        json.dump(output, output_file, indent=2)
+    logging.info(f"Benchmark results written to {args.output}")
+    if args.baseline:
+        compare_to_baseline(results, args.baseline)
+    failed = any(not result["stages"] for result in results)
+    slicer.util.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
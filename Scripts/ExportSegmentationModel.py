@@ -0,0 +1,119 @@
+"""
+Converts a TorchScript segmentation model and its config.json metadata for the RealtimeInference.py backends,
+and checks that the converted model gives the same foreground probabilities as the TorchScript model.
+Usage:
+    python ExportSegmentationModel.py --model model.pt --openvino
+Arguments:
+    model: TorchScript model file with a config.json extra file
+    output: ONNX output file. Defaults to the model file with the .onnx extension
+    openvino: also convert the ONNX model to OpenVINO IR (.xml and .bin next to the ONNX file). Needs openvino
+    opset: ONNX opset version
+    tolerance: largest accepted difference of foreground probabilities between TorchScript and the converted models
+    samples: number of random images used for the check
+"""
+
+import argparse
+import inspect
+import json
+import logging
+import sys
+import traceback
+from pathlib import Path
+
+import numpy as np
+import onnx
+import torch
+
+import RealtimeInference
+
+DEFAULT_OPSET = 17
+
+
+# Parse command line arguments
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, required=True)
+    parser.add_argument("--output", type=str, default=None)
+    parser.add_argument("--openvino", action="store_true")
+    parser.add_argument("--opset", type=int, default=DEFAULT_OPSET)
+    parser.add_argument("--tolerance", type=float, default=1e-4)
+    parser.add_argument("--samples", type=int, default=8)
+    try:
+        return parser.parse_args()
+    except SystemExit as err:
+        traceback.print_exc()
+        sys.exit(err.code)
+
+
+# Exports the model with a dynamic batch size and stores config.json in the ONNX metadata
+def export_onnx(torchscript_backend, output_path, opset):
+    input_size = torchscript_backend.input_size
+    example = torch.rand(1, 1, input_size, input_size, device=torchscript_backend.device)
+    export_options = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        export_options["dynamo"] = False  # script modules need the TorchScript based exporter
+    torch.onnx.export(torchscript_backend.model, example, output_path, input_names=["image"],
+                      output_names=["prediction"], dynamic_axes={"image": {0: "batch"}, "prediction": {0: "batch"}},
+                      opset_version=opset, **export_options)
+
+    onnx_model = onnx.load(output_path)
+    metadata = onnx_model.metadata_props.add()
+    metadata.key = "config.json"
+    metadata.value = json.dumps(torchscript_backend.config)
+    onnx.save(onnx_model, output_path)
+    logging.info(f"Saved {output_path}")
+
+
+# Converts the ONNX model to OpenVINO IR and stores config.json in its runtime info
+def export_openvino(onnx_path, config):
+    import openvino
+
+    model = openvino.convert_model(onnx_path)
+    model.set_rt_info(json.dumps(config), "config.json")
+    output_path = str(Path(onnx_path).with_suffix(".xml"))
+    openvino.save_model(model, output_path)
+    logging.info(f"Saved {output_path}")
+    return output_path
+
+
+def foreground_probability(prediction):
+    return torch.softmax(prediction.float(), dim=1)[:, 1].cpu().numpy()
+
+
+# Returns the largest difference of foreground probabilities between the two backends on random images
+def compare_backends(reference_backend, backend, samples):
+    generator = torch.Generator().manual_seed(0)
+    input_size = reference_backend.input_size
+    largest_difference = 0.0
+    for _ in range(samples):
+        image = torch.rand(1, 1, input_size, input_size, generator=generator)
+        reference = foreground_probability(reference_backend(image.to(reference_backend.device)))
+        converted = foreground_probability(backend(image.to(backend.device)))
+        largest_difference = max(largest_difference, float(np.abs(reference - converted).max()))
+    return largest_difference
+
+
+def main():
+    args = parse_args()
+    checked_args = argparse.Namespace(jit_optimization="none", intra_op_threads=0, inter_op_threads=0)
+    torchscript_backend = RealtimeInference.TorchScriptBackend(args.model, checked_args)
+    onnx_path = args.output or str(Path(args.model).with_suffix(".onnx"))
+    export_onnx(torchscript_backend, onnx_path, args.opset)
+    converted = {"onnxruntime": RealtimeInference.OnnxRuntimeBackend(onnx_path, checked_args)}
+    if args.openvino:
+        xml_path = export_openvino(onnx_path, torchscript_backend.config)
+        converted["openvino"] = RealtimeInference.OpenVinoBackend(xml_path, checked_args)
+
+    failed = False
+    for name, backend in converted.items():
+        difference = compare_backends(torchscript_backend, backend, args.samples)
+        passed = difference <= args.tolerance
+        failed = failed or not passed
+        logging.info(f"{name}: largest foreground probability difference {difference:.2e} "
+                     f"({'within' if passed else 'above'} tolerance {args.tolerance:g})")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    main()
@@ -0,0 +1,214 @@
+"""
+Creates an INT8 version of a TorchScript segmentation model for RealtimeInference.py --int8 by static post-training
+quantization with ONNX Runtime. Activation ranges are calibrated on recorded ultrasound frames, and the INT8 model is
+checked against the FP32 TorchScript model on held-out frames: Dice of the thresholded predictions and inference time.
+Usage:
+    python QuantizeSegmentationModel.py --model model.pt --record 600 --frames-output frames.npz
+    python QuantizeSegmentationModel.py --model model.pt --frames frames.npz --validation-frames case2.npz
+Arguments:
+    model: TorchScript model file with a config.json extra file, relative paths are resolved like RealtimeInference.py
+        does. The INT8 model is written next to it (.int8.onnx). The intermediate FP32 ONNX export goes to a
+        temporary folder, so an existing .onnx file next to the model is not overwritten
+    frames: recorded frames (.npy or .npz of (frames, 1, height, width) uint8 arrays) used for calibration
+    validation frames: recorded frames used for the accuracy check. By default the last part of the frames is held out
+    validation fraction: fraction of the frames held out for the accuracy check when there are no validation frames
+    record: number of frames to record from the PLUS server instead of reading frames from files
+    frames output: .npz file where recorded frames are saved
+    host, input port, input device name: PLUS server and image device used for recording
+    calibration method: minmax, entropy or percentile
+    per channel: quantize convolution weights per output channel
+    threshold: foreground probability threshold of the segmentation masks compared by Dice
+    min dice: the script exits with an error if the mean Dice is below this value
+"""
+
+import argparse
+import json
+import logging
+import sys
+import tempfile
+import time
+import traceback
+from pathlib import Path
+
+import numpy as np
+import onnx
+import torch
+from onnxruntime.quantization import CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType, quantize_static
+from onnxruntime.quantization.shape_inference import quant_pre_process
+
+import ExportSegmentationModel
+import RealtimeInference
+
+CALIBRATION_METHODS = {
+    "minmax": CalibrationMethod.MinMax,
+    "entropy": CalibrationMethod.Entropy,
+    "percentile": CalibrationMethod.Percentile,
+}
+
+
+# Parse command line arguments
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, required=True)
+    parser.add_argument("--frames", type=str, nargs="*", default=[])
+    parser.add_argument("--validation-frames", type=str, nargs="*", default=[])
+    parser.add_argument("--validation-fraction", type=float, default=0.3)
+    parser.add_argument("--record", type=int, default=0)
+    parser.add_argument("--frames-output", type=str, default=None)
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--input-port", type=int, default=18944)
+    parser.add_argument("--input-device-name", type=str, default="Image_Image")
+    parser.add_argument("--calibration-method", type=str, choices=list(CALIBRATION_METHODS), default="minmax")
+    parser.add_argument("--per-channel", action="store_true")
+    parser.add_argument("--threshold", type=float, default=0.5)
+    parser.add_argument("--min-dice", type=float, default=0.0)
+    try:
+        return parser.parse_args()
+    except SystemExit as err:
+        traceback.print_exc()
+        sys.exit(err.code)
+
+
+def load_frames(paths):
+    frames = []
+    for path in paths:
+        data = np.load(path)
+        if isinstance(data, np.lib.npyio.NpzFile):
+            data = data["frames"] if "frames" in data.files else data[data.files[0]]
+        frames.append(data.reshape(-1, 1, data.shape[-2], data.shape[-1]))
+    return np.concatenate(frames) if frames else np.empty((0, 1, 0, 0), dtype=np.uint8)
+
+
+# Receives count image messages from the PLUS server
+def record_frames(args):
+    import pyigtl
+
+    input_client = pyigtl.OpenIGTLinkClient(host=args.host, port=args.input_port)
+    frames = []
+    try:
+        while len(frames) < args.record:
+            message = input_client.wait_for_message(args.input_device_name, timeout=5)
+            if message is None:
+                raise TimeoutError(f"No {args.input_device_name} message received from {args.host}:{args.input_port}")
+            frames.append(np.array(message.image, dtype=np.uint8).reshape(1, *message.image.shape[-2:]))
+    finally:
+        input_client.stop()
+    logging.info(f"Recorded {len(frames)} frames")
+    return np.stack(frames)
+
+
+# Feeds preprocessed frames, as the realtime client passes them to the model, to the ONNX Runtime calibration
+class FrameCalibrationReader(CalibrationDataReader):
+    def __init__(self, frames, input_name, input_size):
+        self.frames = frames
+        self.input_name = input_name
+        self.input_size = input_size
+        self._next_frame = 0
+
+    def get_next(self):
+        if self._next_frame >= len(self.frames):
+            return None
+        image = RealtimeInference.preprocess_input(self.frames[self._next_frame], self.input_size)
+        self._next_frame += 1
+        return {self.input_name: image.numpy()}
+
+    def rewind(self):
+        self._next_frame = 0
+
+
+def quantize_model(onnx_path, int8_path, calibration_frames, input_size, args):
+    preprocessed_path = str(Path(onnx_path).with_suffix(".preprocessed.onnx"))
+    quant_pre_process(onnx_path, preprocessed_path)
+    input_name = onnx.load(preprocessed_path).graph.input[0].name
+    quantize_static(preprocessed_path, int8_path, FrameCalibrationReader(calibration_frames, input_name, input_size),
+                    quant_format=QuantFormat.QDQ, activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                    per_channel=args.per_channel, calibrate_method=CALIBRATION_METHODS[args.calibration_method])
+    Path(preprocessed_path).unlink()
+
+
+def set_metadata(onnx_path, values):
+    onnx_model = onnx.load(onnx_path)
+    existing = {metadata.key: metadata for metadata in onnx_model.metadata_props}
+    for key, value in values.items():
+        metadata = existing[key] if key in existing else onnx_model.metadata_props.add()
+        metadata.key = key
+        metadata.value = value
+    onnx.save(onnx_model, onnx_path)
+
+
+def dice(mask, reference):
+    total = mask.sum() + reference.sum()
+    return 1.0 if total == 0 else 2.0 * np.logical_and(mask, reference).sum() / total
+
+
+# Runs both backends on the frames, with the preprocessing and postprocessing of the realtime client.
+# Returns the Dice of the thresholded INT8 predictions against FP32 and the median inference times.
+def compare_predictions(fp32_backend, int8_backend, frames, threshold):
+    threshold_value = threshold * 255
+    dice_values = []
+    times = {"fp32": [], "int8": []}
+    for frame in frames:
+        masks = {}
+        for name, backend in (("fp32", fp32_backend), ("int8", int8_backend)):
+            image = RealtimeInference.preprocess_input(frame, backend.input_size).to(backend.device)
+            start_time = time.perf_counter()
+            prediction = backend(image)
+            times[name].append((time.perf_counter() - start_time) * 1000.0)
+            prediction = torch.nn.functional.softmax(prediction, dim=1)
+            masks[name] = RealtimeInference.postprocess_prediction(prediction, frame.shape) > threshold_value
+        dice_values.append(dice(masks["int8"], masks["fp32"]))
+    return np.array(dice_values), {name: float(np.median(values)) for name, values in times.items()}
+
+
+def main():
+    args = parse_args()
+    if args.record > 0:
+        frames = record_frames(args)
+        if args.frames_output:
+            np.savez_compressed(args.frames_output, frames=frames)
+            logging.info(f"Saved frames to {args.frames_output}")
+    else:
+        frames = load_frames(args.frames)
+    validation_frames = load_frames(args.validation_frames)
+    if len(validation_frames) == 0:
+        # Consecutive frames are similar, so the held out frames are the end of the recording, not a random sample
+        held_out = int(round(len(frames) * args.validation_fraction))
+        frames, validation_frames = frames[:len(frames) - held_out], frames[len(frames) - held_out:]
+    if len(frames) == 0 or len(validation_frames) == 0:
+        logging.error("Frames are needed both for calibration and for the accuracy check")
+        sys.exit(1)
+    logging.info(f"Calibrating on {len(frames)} frames, checking on {len(validation_frames)} frames")
+
+    backend_args = argparse.Namespace(jit_optimization="none", intra_op_threads=0, inter_op_threads=0)
+    model_path = RealtimeInference.resolve_model_path(args.model)
+    fp32_backend = RealtimeInference.TorchScriptBackend(model_path, backend_args)
+    int8_path = RealtimeInference.int8_model_path(model_path)
+    with tempfile.TemporaryDirectory() as temp_folder:
+        onnx_path = str(Path(temp_folder) / Path(model_path).with_suffix(".onnx").name)
+        ExportSegmentationModel.export_onnx(fp32_backend, onnx_path, ExportSegmentationModel.DEFAULT_OPSET)
+        quantize_model(onnx_path, int8_path, frames, fp32_backend.input_size, args)
+    set_metadata(int8_path, {"config.json": json.dumps(fp32_backend.config)})
+
+    int8_backend = RealtimeInference.OnnxRuntimeBackend(int8_path, backend_args)
+    dice_values, times = compare_predictions(fp32_backend, int8_backend, validation_frames, args.threshold)
+    report = {
+        "calibration_frames": len(frames),
+        "validation_frames": len(validation_frames),
+        "calibration_method": args.calibration_method,
+        "per_channel": args.per_channel,
+        "threshold": args.threshold,
+        "mean_dice": float(dice_values.mean()),
+        "min_dice": float(dice_values.min()),
+        "fp32_median_ms": times["fp32"],
+        "int8_median_ms": times["int8"],
+    }
+    set_metadata(int8_path, {"quantization.json": json.dumps(report)})
+    logging.info(f"Saved {int8_path}")
+    logging.info(f"Dice against FP32: mean {report['mean_dice']:.4f}, min {report['min_dice']:.4f}. "
+                 f"Median inference {times['fp32']:.1f} ms FP32 TorchScript, {times['int8']:.1f} ms INT8")
+    sys.exit(1 if report["mean_dice"] < args.min_dice else 0)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    main()
@@ -0,0 +1,125 @@
+"""
+Tests of the RealtimeInference.py stages that do not need a PLUS server or a model.
+Usage:
+    python -m unittest RealtimeInferenceTest
+"""
+
+import threading
+import time
+import unittest
+
+import numpy as np
+import pyigtl
+import torch
+
+import RealtimeInference
+
+
+class LatestValueQueueTest(unittest.TestCase):
+    def test_keeps_latest_value_per_key(self):
+        dropped = []
+        queue = RealtimeInference.LatestValueQueue("test", on_drop=dropped.append)
+        for frame in range(5):
+            queue.put("Image_Image", frame)
+        queue.put("ImageToReference", "transform")
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(queue.get(timeout=0), ("Image_Image", 4))
+        self.assertEqual(queue.get(timeout=0), ("ImageToReference", "transform"))
+        self.assertEqual(dropped, [0, 1, 2, 3])
+        self.assertEqual(queue.stats(), {"depth": 0, "queued": 6, "dropped": 4})
+
+    def test_returns_keys_in_order_of_first_put(self):
+        queue = RealtimeInference.LatestValueQueue("test")
+        queue.put("a", 1)
+        queue.put("b", 2)
+        queue.put("a", 3)  # replaces the value, so "a" moves behind "b"
+        self.assertEqual(queue.get(timeout=0), ("b", 2))
+        self.assertEqual(queue.get(timeout=0), ("a", 3))
+
+    def test_get_times_out_when_empty(self):
+        queue = RealtimeInference.LatestValueQueue("test")
+        start_time = time.perf_counter()
+        self.assertIsNone(queue.get(timeout=0.05))
+        self.assertGreaterEqual(time.perf_counter() - start_time, 0.04)
+
+    def test_slow_consumer_gets_newest_frames(self):
+        queue = RealtimeInference.LatestValueQueue("test")
+        frame_count = 200
+        received = []
+
+        def consume():
+            while True:
+                item = queue.get(timeout=1.0)
+                if item is None or item[0] == "stop":
+                    return
+                received.append(item[1])
+                time.sleep(0.005)  # slower than the producer
+
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+        for frame in range(frame_count):
+            queue.put("Image_Image", frame)
+            time.sleep(0.0005)
+        queue.put("stop", None)  # taken after the last frame, which was put first
+        consumer.join()
+
+        self.assertEqual(received, sorted(set(received)))
+        self.assertEqual(received[-1], frame_count - 1)
+        self.assertLess(len(received), frame_count)
+        self.assertEqual(queue.stats()["queued"], frame_count + 1)
+        self.assertEqual(queue.stats()["dropped"], frame_count - len(received))
+
+
+
+class FrameProcessorTest(unittest.TestCase):
+    INPUT_SIZE = 128
+    FRAME_SHAPE = (1, 525, 615)
+
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+        self.processor = RealtimeInference.FrameProcessor(self.INPUT_SIZE, torch.device("cpu"))
+
+    def make_frame(self):
+        return self.rng.integers(0, 256, size=self.FRAME_SHAPE, dtype=np.uint8)
+
+    def test_preprocess_matches_legacy(self):
+        for _ in range(3):
+            frame = self.make_frame()
+            expected = RealtimeInference.preprocess_input(frame, self.INPUT_SIZE)
+            actual = self.processor.preprocess(frame)
+            self.assertEqual(actual.shape, expected.shape)
+            self.assertEqual(actual.dtype, torch.float32)
+            torch.testing.assert_close(actual, expected, rtol=0, atol=1e-6)
+
+    def test_postprocess_matches_legacy(self):
+        # Converting to uint8 before resizing changes the output by at most 1 gray level
+        for class_count in (2, 3):
+            logits = torch.from_numpy(self.rng.normal(scale=4.0, size=(1, class_count, self.INPUT_SIZE, self.INPUT_SIZE))
+                                      .astype(np.float32))
+            expected = RealtimeInference.postprocess_prediction(torch.nn.functional.softmax(logits, dim=1),
+                                                                self.FRAME_SHAPE)
+            actual = self.processor.postprocess(logits, self.FRAME_SHAPE)
+            self.assertEqual(actual.shape, expected.shape)
+            self.assertEqual(actual.dtype, np.uint8)
+            difference = np.abs(actual.astype(np.int16) - expected.astype(np.int16))
+            self.assertLessEqual(difference.max(), 1)
+
+    def test_output_buffers_are_reused_after_release(self):
+        logits = torch.zeros((1, 2, self.INPUT_SIZE, self.INPUT_SIZE))
+        first = self.processor.postprocess(logits, self.FRAME_SHAPE)
+        second = self.processor.postprocess(logits, self.FRAME_SHAPE)
+        self.assertFalse(np.shares_memory(first, second))  # first is still in use
+
+        self.processor.release_message(pyigtl.ImageMessage(first, device_name="Prediction"))
+        third = self.processor.postprocess(logits, self.FRAME_SHAPE)
+        self.assertTrue(np.shares_memory(first, third))
+
+        # Buffers of another frame size are not reused
+        self.processor.release_message(pyigtl.ImageMessage(third, device_name="Prediction"))
+        other = self.processor.postprocess(logits, (1, 300, 400))
+        self.assertEqual(other.shape, (1, 300, 400))
+        self.assertFalse(np.shares_memory(third, other))
+
+
+if __name__ == "__main__":
+    unittest.main()
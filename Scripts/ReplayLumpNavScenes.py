@@ -0,0 +1,119 @@
+"""
+Replays saved LumpNav2 scenes without rendering and writes the iKnife sync tracking data of each case.
+Tracking values are recomputed by LumpNav2Logic.replayTrackingData, the batch version of the live tracking log.
+The saved tumor model is used for all frames, so tumor distance, margin distances, tumor center and size of frames
+recorded before the last tumor edit differ from the live log.
+Run with 3D Slicer in batch mode:
+    Slicer --no-main-window --python-script ReplayLumpNavScenes.py --output-dir D:/SyncData D:/Cases/*/LumpNav2-*.mrb
+Arguments:
+    scenes: saved LumpNav2 scene files (.mrb) or glob patterns
+    output dir: folder of the output files. Files are written next to each scene by default
+    format: csv (same columns as the live export) or parquet (numeric columns, needs pyarrow)
+    workers: number of cases processed in parallel. Each case runs in its own Slicer process
+"""
+
+import argparse
+import concurrent.futures
+import glob
+import logging
+import os
+import subprocess
+import sys
+import time
+import traceback
+
+import slicer
+
+
+# Parse command line arguments
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenes", type=str, nargs="+")
+    parser.add_argument("--output-dir", type=str, default=None)
+    parser.add_argument("--format", type=str, choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    try:
+        return parser.parse_args(sys.argv[1:])
+    except SystemExit as err:
+        traceback.print_exc()
+        slicer.util.exit(err.code)
+
+
+def find_scenes(patterns):
+    scene_paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            logging.warning(f"No scene found for {pattern}")
+        scene_paths.extend(os.path.abspath(match) for match in matches)
+    return scene_paths
+
+
+# Loads one scene, recomputes its tracking log and writes it. Returns the output file path.
+def replay_scene(scene_path, output_dir, output_format):
+    import LumpNav2
+
+    start_time = time.time()
+    slicer.mrmlScene.Clear(0)
+    slicer.util.loadScene(scene_path)
+    logic = LumpNav2.LumpNav2Logic()
+    tracking_data = logic.replayTrackingData()
+
+    scene_name = os.path.splitext(os.path.basename(scene_path))[0]
+    output_dir = output_dir or os.path.dirname(scene_path)
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, f"iKnifeSyncData_{scene_name}.{output_format}")
+    if output_format == "parquet":
+        tracking_data.toNumericDataFrame().to_parquet(output_path, index=False)
+    else:
+        tracking_data.toDataFrame().to_csv(output_path, index=False)
+    logging.info(f"Replayed {len(tracking_data)} frames of {scene_path} in {time.time() - start_time:.1f} s")
+    logging.info("Tumor distances are measured against the saved tumor model, not the tumor at each frame time")
+    return output_path
+
+
+# Runs each scene in a separate Slicer process, at most args.workers at a time.
+def replay_scenes_in_parallel(scene_paths, args):
+    slicer_executable = slicer.app.applicationFilePath()
+    script_path = os.path.abspath(sys.argv[0])
+
+    def run_case(scene_path):
+        command = [slicer_executable, "--no-main-window", "--no-splash", "--python-script", script_path,
+                   "--format", args.format, "--workers", "1"]
+        if args.output_dir:
+            command += ["--output-dir", args.output_dir]
+        command.append(scene_path)
+        return subprocess.run(command, capture_output=True, text=True)
+
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(run_case, scene_path): scene_path for scene_path in scene_paths}
+        for future in concurrent.futures.as_completed(futures):
+            scene_path = futures[future]
+            result = future.result()
+            if result.returncode == 0:
+                logging.info(f"Finished {scene_path}")
+            else:
+                logging.error(f"Failed {scene_path}:\n{result.stdout}\n{result.stderr}")
+                failed.append(scene_path)
+    return failed
+
+
+def main():
+    args = parse_args()
+    scene_paths = find_scenes(args.scenes)
+    if len(scene_paths) > 1 and args.workers > 1:
+        failed = replay_scenes_in_parallel(scene_paths, args)
+    else:
+        failed = []
+        for scene_path in scene_paths:
+            try:
+                replay_scene(scene_path, args.output_dir, args.format)
+            except Exception:
+                logging.error(f"Failed {scene_path}:\n{traceback.format_exc()}")
+                failed.append(scene_path)
+    slicer.util.exit(1 if failed or not scene_paths else 0)
+
+
+if __name__ == "__main__":
+    main()
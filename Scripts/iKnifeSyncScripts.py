@@ -234,3 +234,21 @@ df = pd.DataFrame(positionMatrix, ["Time (s)", "Cautery Tip Needle", "Distance T
 # df = pd.DataFrame(positionMatrix, ["Time (s)", "CauteryTip_Needle", "Distance To Tumour (mm)"])
 df = df.T
 df.to_csv(r"c:\Users\Chris Yeung\Queen's University\Amoon Jamzad - Breast_navigated_iKnife\2024-07-26_FirstCase\iKnifeSyncData.csv")
+
+# ---------------------------------------------------
+# Extract the whole cautery trajectory without stepping through the sequence browser
+# ---------------------------------------------------
+
+import pandas as pd
+bn = slicer.mrmlScene.GetFirstNodeByName('TrackingSequenceBrowser')
+trajectory = slicer.util.getModuleLogic('LumpNav2').getTrackingTrajectory(bn)
+df = pd.DataFrame({
+    "Time (s)": trajectory["time"],
+    "Cautery Tip Needle X": trajectory["tipNeedle"][:, 0],
+    "Cautery Tip Needle Y": trajectory["tipNeedle"][:, 1],
+    "Cautery Tip Needle Z": trajectory["tipNeedle"][:, 2],
+    "Cautery Tip RAS X": trajectory["tipRas"][:, 0],
+    "Cautery Tip RAS Y": trajectory["tipRas"][:, 1],
+    "Cautery Tip RAS Z": trajectory["tipRas"][:, 2],
+})
+df.to_csv("iKnifeTrajectory.csv", index=False)